@@ -168,7 +168,7 @@
     defaults.autodetected = "-a -o on -s (S/../.././02|L/../15/./02)";
     notifications = {
       mail.enable = true;
-      mail.mailer = "${config.services.mail2discord.package}/bin/mail2discord";
+      mail.mailer = config.services.mail2discord.sendmail;
       test = true;
     };
   };
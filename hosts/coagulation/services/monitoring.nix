@@ -63,6 +63,14 @@
           }
         ];
       }
+      {
+        job_name = "smartmon-helper";
+        static_configs = [
+          {
+            targets = [ "127.0.0.1:9633" ];
+          }
+        ];
+      }
       {
         job_name = "cadvisor";
         static_configs = [
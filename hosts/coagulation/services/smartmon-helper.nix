@@ -5,13 +5,20 @@ let
 in
 {
   systemd.services.smartmon-helper = {
-    description = "Read-only smartctl snapshot";
+    description = "Read-only smartctl snapshot daemon";
+    wantedBy = [ "multi-user.target" ];
+    after = [ "systemd-udevd.service" ];
     serviceConfig = {
-      Type = "oneshot";
+      Type = "simple";
       User = "root";
       Group = "users";
       UMask = "0137";
-      ExecStart = "${smartmon-helper}/bin/smartmon-helper --smartctl ${pkgs.smartmontools}/bin/smartctl --output /var/lib/smartmon-helper/snapshot.json";
+      # Full --all query hourly, NVMe health/temperature every minute; rescans on udev block events.
+      # Sleeping archive disks are left in standby and reported from the last awake result.
+      # Metrics are served on localhost and scraped by Prometheus (see monitoring.nix).
+      ExecStart = "${smartmon-helper}/bin/smartmon-helper --daemon --smartctl ${pkgs.smartmontools}/bin/smartctl --udevadm ${pkgs.systemd}/bin/udevadm --skip-standby --interval 3600 --nvme-interval 60 --output /var/lib/smartmon-helper/snapshot.json --listen 127.0.0.1:9633 --raw-dir /var/lib/smartmon-helper/raw --raw-compress --history /var/lib/smartmon-helper/history.sqlite3 --diff /var/lib/smartmon-helper/diff.json";
+      Restart = "on-failure";
+      RestartSec = "30s";
       StateDirectory = "smartmon-helper";
       StateDirectoryMode = "0750";
       ProtectSystem = "strict";
@@ -19,14 +26,4 @@ in
       PrivateTmp = true;
     };
   };
-
-  systemd.timers.smartmon-helper = {
-    description = "Periodic read-only SMART snapshot";
-    wantedBy = [ "timers.target" ];
-    timerConfig = {
-      OnCalendar = "*:0/15";
-      Persistent = true;
-      Unit = "smartmon-helper.service";
-    };
-  };
 }
@@ -7,6 +7,21 @@
 
 let
   cfg = config.services.mail2discord;
+
+  # Callers such as smartd exec the shim directly, so bake the spool location in
+  sendmail = pkgs.writeShellScriptBin "mail2discord" ''
+    export MAIL2DISCORD_SPOOL=${lib.escapeShellArg cfg.spoolDir}
+    exec ${cfg.package}/bin/mail2discord "$@"
+  '';
+
+  # The path unit re-triggers as soon as the worker exits while entries are
+  # still queued; after a transient failure, hold the unit in deactivating
+  # for the retry delay so that becomes a paced retry instead of a spin.
+  retryDelay = pkgs.writeShellScript "mail2discord-retry-delay" ''
+    if [ "$EXIT_STATUS" = 75 ]; then
+      exec ${pkgs.coreutils}/bin/sleep ${toString cfg.retryDelay}
+    fi
+  '';
 in
 {
   options.services.mail2discord = {
@@ -47,6 +62,43 @@ in
       default = "/usr/sbin/sendmail";
       description = "Location for the system sendmail symlink.";
     };
+
+    spoolDir = lib.mkOption {
+      type = lib.types.str;
+      default = "/var/spool/mail2discord";
+      description = ''
+        Directory where the sendmail shim queues messages. The delivery
+        service drains it whenever new mail arrives and retries every
+        retryDelay seconds until Discord accepts the messages.
+      '';
+    };
+
+    retryDelay = lib.mkOption {
+      type = lib.types.ints.positive;
+      default = 60;
+      description = ''
+        Seconds to wait after a transient delivery failure (network error,
+        Discord 5xx or rate limit) before the queue is tried again.
+      '';
+    };
+
+    batchWindow = lib.mkOption {
+      type = lib.types.ints.unsigned;
+      default = 10;
+      description = ''
+        Seconds the delivery worker waits after new mail arrives before
+        posting, so a burst of alerts is coalesced (identical messages become
+        one embed with a count) and packed up to 10 embeds per webhook post.
+        0 posts immediately.
+      '';
+    };
+
+    sendmail = lib.mkOption {
+      type = lib.types.str;
+      readOnly = true;
+      default = "${sendmail}/bin/mail2discord";
+      description = "Sendmail-compatible shim that queues into spoolDir; use it as a mailer for other services.";
+    };
   };
 
   config = lib.mkIf cfg.enable {
@@ -57,18 +109,100 @@ in
       mode = cfg.secretMode;
     };
 
-    environment.systemPackages = [ cfg.package ];
+    environment.systemPackages = [ sendmail ];
 
     # Provide an alternatives-managed sendmail that points at our wrapper.
     # We'll install a wrapper in /run/current-system/sw/bin/sendmail-mail2discord via the package
     # and expose it as the system's sendmail through /etc/alternatives and /usr/sbin/sendmail.
-    environment.etc."alternatives/sendmail".source = "${cfg.package}/bin/mail2discord";
+    environment.etc."alternatives/sendmail".source = cfg.sendmail;
+
+    # The delivery worker runs unprivileged and owns the spool
+    users.users.mail2discord = {
+      isSystemUser = true;
+      group = "mail2discord";
+    };
+    users.groups.mail2discord = { };
 
     # Ensure directory exists and create /usr/sbin/sendmail -> /etc/alternatives/sendmail
+    # The spool's tmp/ and new/ are writable (but not listable) by every local sender.
+    # setgid hands queued files to the mail2discord group, so the shim's 0640
+    # files are readable by the worker and nobody else.
     systemd.tmpfiles.rules = [
       "L+ ${cfg.sendmailPath} - - - - /etc/alternatives/sendmail"
+      "d ${cfg.spoolDir} 0755 mail2discord mail2discord -"
+      "d ${cfg.spoolDir}/tmp 3733 mail2discord mail2discord -"
+      "d ${cfg.spoolDir}/new 3733 mail2discord mail2discord -"
+      "d ${cfg.spoolDir}/failed 0700 mail2discord mail2discord -"
+      # Rate-limit state shared by the worker and every inline sender
+      "f ${cfg.spoolDir}/ratelimit.json 0666 mail2discord mail2discord -"
     ];
 
+    systemd.services.mail2discord-deliver = {
+      description = "Deliver spooled mail to Discord";
+      after = [ "network-online.target" ];
+      wants = [ "network-online.target" ];
+      environment = {
+        MAIL2DISCORD_SPOOL = cfg.spoolDir;
+        MAIL2DISCORD_BATCH_WINDOW = toString cfg.batchWindow;
+        # Handed over by systemd, whatever the secret's owner and mode
+        DISCORD_WEBHOOK_FILE = "%d/webhook";
+      };
+      serviceConfig = {
+        Type = "oneshot";
+        ExecStart = "${cfg.package}/bin/mail2discord --deliver";
+        # Transient Discord/network failure: back off, then the path unit retries
+        SuccessExitStatus = [ 75 ];
+        ExecStopPost = retryDelay;
+        TimeoutStopSec = cfg.retryDelay + 30;
+
+        # Everything in the spool is written by untrusted local users
+        User = "mail2discord";
+        Group = "mail2discord";
+        LoadCredential = [ "webhook:${config.sops.secrets."${cfg.secretName}".path}" ];
+        UMask = "0077";
+        ProtectSystem = "strict";
+        ReadWritePaths = [ cfg.spoolDir ];
+        ProtectHome = true;
+        PrivateTmp = true;
+        PrivateDevices = true;
+        NoNewPrivileges = true;
+        CapabilityBoundingSet = "";
+        ProtectKernelTunables = true;
+        ProtectKernelModules = true;
+        ProtectControlGroups = true;
+        RestrictAddressFamilies = [
+          "AF_UNIX"
+          "AF_INET"
+          "AF_INET6"
+        ];
+        RestrictSUIDSGID = true;
+        RestrictNamespaces = true;
+        LockPersonality = true;
+        SystemCallArchitectures = "native";
+      };
+    };
+
+    # Only complete entries trigger delivery; attachments are renamed into
+    # new/ before their .json and orphans are cleaned up by the worker.
+    systemd.paths.mail2discord-deliver = {
+      wantedBy = [ "paths.target" ];
+      pathConfig = {
+        PathExistsGlob = "${cfg.spoolDir}/new/*.json";
+        TriggerLimitIntervalSec = "1min";
+        TriggerLimitBurst = 10;
+      };
+    };
+
+    # Safety net: picks up the queue after boot or if the path unit hit its
+    # trigger limit
+    systemd.timers.mail2discord-deliver = {
+      wantedBy = [ "timers.target" ];
+      timerConfig = {
+        OnBootSec = "1min";
+        OnUnitInactiveSec = "1min";
+      };
+    };
+
     # Document the dependency on sops-nix activation
     assertions = [
       {
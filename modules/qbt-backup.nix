@@ -7,6 +7,18 @@
 let
   cfg = config.services.qbt-backup;
   qbt-backup-pkg = pkgs.callPackage ../pkgs/qbt-backup/package.nix { };
+
+  captureMethod = lib.types.enum [
+    "none"
+    "btrfs"
+    "zfs"
+    "api"
+  ];
+
+  # "name=value,name2=value2" as parsed by qbt-backup
+  instanceMap = attrs: lib.concatStringsSep "," (lib.mapAttrsToList (name: value: "${name}=${value}") attrs);
+
+  captureMethods = [ cfg.capture.default ] ++ lib.attrValues cfg.capture.instances;
 in
 {
   options.services.qbt-backup = {
@@ -48,10 +60,128 @@ in
       description = "Group to run the backup service as.";
     };
 
+    compression = lib.mkOption {
+      type = lib.types.enum [
+        "gzip"
+        "zstd"
+        "lz4"
+        "none"
+      ];
+      default = "gzip";
+      description = ''
+        Archive codec. "zstd" compresses with multiple threads and long-distance
+        matching, "lz4" trades ratio for speed, "none" writes a plain tar.
+      '';
+    };
+
     compressionLevel = lib.mkOption {
       type = lib.types.int;
       default = 6;
-      description = "Gzip compression level (1-9).";
+      description = "Compression level for the selected codec (gzip 1-9, zstd 1-19, lz4 0-16).";
+    };
+
+    compressionThreads = lib.mkOption {
+      type = lib.types.ints.unsigned;
+      default = 0;
+      description = "Threads per zstd archive (0 = one per CPU core).";
+    };
+
+    workers = lib.mkOption {
+      type = lib.types.ints.positive;
+      default = 1;
+      description = "Number of instances to back up in parallel (one process each).";
+    };
+
+    mode = lib.mkOption {
+      type = lib.types.enum [
+        "archive"
+        "incremental"
+      ];
+      default = "archive";
+      description = ''
+        Backup format. "archive" writes a full tarball per run, compressed with
+        the codec chosen by `compression` (.tar.gz, .tar.zst, .tar.lz4 or plain
+        .tar). "incremental" stores file contents in a per-instance blob store
+        keyed by SHA-256 (always gzip; `compression` does not apply) and writes
+        only a small manifest plus changed files per run; restore with
+        `qbt-backup restore`.
+      '';
+    };
+
+    skipUnchanged = lib.mkOption {
+      type = lib.types.bool;
+      default = true;
+      description = ''
+        Fingerprint each instance before archiving and, if nothing changed since the
+        last backup, promote that backup instead of compressing the same data again.
+        Ignored for instances using the "api" capture method: pausing makes
+        qBittorrent rewrite its resume data, so they never look unchanged.
+        Incremental mode still skips re-reading their unchanged files.
+      '';
+    };
+
+    promotionMethod = lib.mkOption {
+      type = lib.types.enum [
+        "auto"
+        "hardlink"
+        "reflink"
+        "copy"
+      ];
+      default = "auto";
+      description = ''
+        How a finished backup is placed into each retention tier. "auto" tries a
+        hardlink, then a reflink, then a plain copy. "hardlink" and "reflink" still
+        fall back to copying when the filesystem can't do them.
+      '';
+    };
+
+    capture = {
+      default = lib.mkOption {
+        type = captureMethod;
+        default = "none";
+        description = ''
+          How to get a consistent view of an instance before archiving it. "none" reads
+          the live directory. "btrfs" and "zfs" archive from a snapshot of the subvolume
+          or dataset holding the instance. "api" pauses running torrents through the
+          local WebUI API, copies the state aside, and resumes them right away.
+        '';
+      };
+
+      instances = lib.mkOption {
+        type = lib.types.attrsOf captureMethod;
+        default = { };
+        example = {
+          main = "btrfs";
+          seedbox = "api";
+        };
+        description = "Per-instance overrides of capture.default.";
+      };
+
+      apiUrls = lib.mkOption {
+        type = lib.types.attrsOf lib.types.str;
+        default = { };
+        example = {
+          seedbox = "http://127.0.0.1:8080";
+        };
+        description = "WebUI base URL of each instance using the \"api\" capture method.";
+      };
+
+      apiUsername = lib.mkOption {
+        type = lib.types.nullOr lib.types.str;
+        default = null;
+        description = "WebUI username, only needed if localhost authentication bypass is off.";
+      };
+
+      apiPasswordFile = lib.mkOption {
+        type = lib.types.nullOr lib.types.str;
+        default = null;
+        example = "/run/secrets/qbittorrent-webui";
+        description = ''
+          Path to a file containing the WebUI password for apiUsername. It is
+          read at runtime, so use a string path (e.g. a sops secret) rather
+          than a path literal, which would copy the password into the Nix store.
+        '';
+      };
     };
 
     retention = {
@@ -64,6 +194,12 @@ in
           default = 24;
           description = "Number of hourly backups to keep.";
         };
+        maxAge = lib.mkOption {
+          type = lib.types.nullOr lib.types.str;
+          default = null;
+          example = "14d";
+          description = "Prune hourly backups older than this (\"36h\", \"14d\", \"8w\").";
+        };
       };
       daily = {
         enable = lib.mkEnableOption "daily backups" // {
@@ -74,6 +210,12 @@ in
           default = 7;
           description = "Number of daily backups to keep.";
         };
+        maxAge = lib.mkOption {
+          type = lib.types.nullOr lib.types.str;
+          default = null;
+          example = "14d";
+          description = "Prune daily backups older than this (\"36h\", \"14d\", \"8w\").";
+        };
       };
       weekly = {
         enable = lib.mkEnableOption "weekly backups" // {
@@ -84,6 +226,12 @@ in
           default = 4;
           description = "Number of weekly backups to keep.";
         };
+        maxAge = lib.mkOption {
+          type = lib.types.nullOr lib.types.str;
+          default = null;
+          example = "14d";
+          description = "Prune weekly backups older than this (\"36h\", \"14d\", \"8w\").";
+        };
       };
       monthly = {
         enable = lib.mkEnableOption "monthly backups" // {
@@ -94,6 +242,24 @@ in
           default = 6;
           description = "Number of monthly backups to keep.";
         };
+        maxAge = lib.mkOption {
+          type = lib.types.nullOr lib.types.str;
+          default = null;
+          example = "14d";
+          description = "Prune monthly backups older than this (\"36h\", \"14d\", \"8w\").";
+        };
+      };
+
+      maxBytesPerInstance = lib.mkOption {
+        type = lib.types.nullOr lib.types.ints.positive;
+        default = null;
+        description = "Byte budget per instance. Oldest backups are pruned first; the newest is always kept. Incremental backups count their manifests plus the blob store they reference.";
+      };
+
+      maxBytesTotal = lib.mkOption {
+        type = lib.types.nullOr lib.types.ints.positive;
+        default = null;
+        description = "Byte budget for the whole backup root. Oldest backups are pruned first; the newest of each instance is always kept.";
       };
 
       promotionHour = lib.mkOption {
@@ -120,7 +286,13 @@ in
         QBT_SOURCE_ROOT = cfg.sourceRoot;
         QBT_BACKUP_ROOT = cfg.backupRoot;
         QBT_MOUNT_POINT = cfg.mountPoint;
+        QBT_COMPRESSION = cfg.compression;
         QBT_COMPRESSION_LEVEL = toString cfg.compressionLevel;
+        QBT_COMPRESSION_THREADS = toString cfg.compressionThreads;
+        QBT_BACKUP_MODE = cfg.mode;
+        QBT_WORKERS = toString cfg.workers;
+        QBT_PROMOTION_METHOD = cfg.promotionMethod;
+        QBT_SKIP_UNCHANGED = if cfg.skipUnchanged then "true" else "false";
 
         QBT_ENABLE_HOURLY = if cfg.retention.hourly.enable then "true" else "false";
         QBT_KEEP_HOURLY = toString cfg.retention.hourly.keep;
@@ -135,10 +307,37 @@ in
 
         QBT_KEEP_MONTHLY = toString cfg.retention.monthly.keep;
 
+        QBT_MAX_AGE_HOURLY = lib.optionalString (cfg.retention.hourly.maxAge != null) cfg.retention.hourly.maxAge;
+        QBT_MAX_AGE_DAILY = lib.optionalString (cfg.retention.daily.maxAge != null) cfg.retention.daily.maxAge;
+        QBT_MAX_AGE_WEEKLY = lib.optionalString (cfg.retention.weekly.maxAge != null) cfg.retention.weekly.maxAge;
+        QBT_MAX_AGE_MONTHLY = lib.optionalString (
+          cfg.retention.monthly.maxAge != null
+        ) cfg.retention.monthly.maxAge;
+
+        QBT_MAX_BYTES_PER_INSTANCE = toString (
+          if cfg.retention.maxBytesPerInstance != null then cfg.retention.maxBytesPerInstance else 0
+        );
+        QBT_MAX_BYTES_TOTAL = toString (
+          if cfg.retention.maxBytesTotal != null then cfg.retention.maxBytesTotal else 0
+        );
+
         QBT_PROMOTION_HOUR =
           if cfg.retention.promotionHour != null then toString cfg.retention.promotionHour else "-1";
+
+        QBT_CAPTURE_DEFAULT = cfg.capture.default;
+        QBT_CAPTURE = instanceMap cfg.capture.instances;
+        QBT_API_URLS = instanceMap cfg.capture.apiUrls;
+        QBT_API_USERNAME = lib.optionalString (cfg.capture.apiUsername != null) cfg.capture.apiUsername;
+        QBT_API_PASSWORD_FILE = lib.optionalString (
+          cfg.capture.apiPasswordFile != null
+        ) cfg.capture.apiPasswordFile;
       };
 
+      # Snapshot tooling for the btrfs/zfs capture methods
+      path =
+        lib.optional (lib.elem "btrfs" captureMethods) pkgs.btrfs-progs
+        ++ lib.optional (lib.elem "zfs" captureMethods) config.boot.zfs.package;
+
       serviceConfig = {
         Type = "oneshot";
         User = cfg.user;
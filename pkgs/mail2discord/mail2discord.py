@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import sys
 import os
+import re
+import stat
 import json
 import socket
 import argparse
 import time
-import urllib.request
-import urllib.error
+import fcntl
+import hashlib
+import contextlib
+import glob
+import mimetypes
+from html.parser import HTMLParser
+import ssl
+import http.client
+import urllib.parse
 import datetime
 from email import policy
 from email.parser import BytesParser
@@ -22,6 +31,51 @@ LIMIT_DESC = 4096
 # We reserve space for markdown code fences (```text ... ```)
 MAX_BODY_LEN = 3900
 
+# Spool: the sendmail shim drops messages here and returns at once;
+# `mail2discord --deliver` drains it. tmp/ -> new/ rename keeps writes atomic,
+# undeliverable messages go to failed/.
+SPOOL_DIR = os.environ.get("MAIL2DISCORD_SPOOL", "/var/spool/mail2discord")
+EX_TEMPFAIL = 75
+# Leftovers of a sender killed mid-enqueue are removed after this long
+STALE_AGE = 3600
+# new/ is writable by every local user: entries are untrusted input
+MAX_ENTRY_BYTES = 1024 * 1024
+CONTENT_TYPE_RE = re.compile(r"[\w!#$&^.+-]+/[\w!#$&^.+-]+(; ?charset=[\w.:-]+)?")
+
+# Batching: the worker waits this long for an alert storm to settle, then
+# packs queued mail into as few webhook posts as Discord allows.
+BATCH_WINDOW = float(os.environ.get("MAIL2DISCORD_BATCH_WINDOW", "0"))
+LIMIT_EMBEDS = 10
+LIMIT_EMBED_TOTAL = 6000
+
+# Long bodies: the embed keeps a preview, the full text goes up as a file
+PREVIEW_LINES = 15
+BODY_ATTACHMENT = "message.txt"
+# Discord webhook upload limits
+MAX_ATTACHMENTS = 10
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Rate-limit state learned from X-RateLimit-* headers, shared by every
+# mail2discord process on the host so they pace themselves before Discord
+# starts answering 429. The NixOS module pre-creates it writable by every
+# sender; the state is advisory, 429s are always honoured locally as well.
+RATELIMIT_FILE = os.environ.get("MAIL2DISCORD_RATELIMIT_FILE", os.path.join(SPOOL_DIR, "ratelimit.json"))
+# Never trust a reset further away than this (clock skew, bogus headers)
+MAX_RATELIMIT_WAIT = 60.0
+
+# One keep-alive connection per process, reused across posts and retries
+CONNECT_TIMEOUT = float(os.environ.get("MAIL2DISCORD_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("MAIL2DISCORD_READ_TIMEOUT", "30"))
+
+
+class DeliveryError(Exception):
+    """Webhook delivery failed; permanent errors will never succeed on retry."""
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
 def load_secret():
     global WEBHOOK_URL
     if WEBHOOK_URL:
@@ -41,107 +95,755 @@ def get_color(subject):
         return 5763719   # Green (0x57F287)
     return 3447003       # Blue (0x3498DB) default
 
-def send_to_discord(subject, sender, body):
-    if not WEBHOOK_URL:
-        print("ERR: No Webhook URL found.", file=sys.stderr)
-        return
-
+def build_embed(subject, sender, body, timestamp=None, count=1, max_body=MAX_BODY_LEN, attached=()):
     # 1. Truncate Body & Wrap in Code Block
-    if len(body) > MAX_BODY_LEN:
-        body = body[:MAX_BODY_LEN] + "\n... [Truncated]"
+    if len(body) > max_body:
+        body = body[:max_body] + "\n... [Truncated]"
     
     formatted_body = f"```text\n{body}\n```"
+    if attached:
+        formatted_body += "\nAttached: " + ", ".join(attached)
+
+    footer = f"From: {sender} • Host: {HOSTNAME}"
+    title = subject
+    if count > 1:
+        title = f"[x{count}] {subject}"
+        footer += f" • {count} identical messages"
 
     # 2. Construct Embed
-    embed = {
-        "title": subject[:LIMIT_TITLE],
+    return {
+        "title": title[:LIMIT_TITLE],
         "description": formatted_body,
         "color": get_color(subject),
-        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "timestamp": timestamp or datetime.datetime.utcnow().isoformat(),
         "footer": {
-             "text": f"From: {sender} • Host: {HOSTNAME}"
+             "text": footer
         }
     }
 
-    payload = {
+def build_payload(subject, sender, body, timestamp=None, attached=()):
+    return {
         "username": "Smartd",
-        "embeds": [embed]
+        "embeds": [build_embed(subject, sender, body, timestamp, attached=attached)]
     }
-    
-    data = json.dumps(payload).encode('utf-8')
-    headers = {'Content-Type': 'application/json', 'User-Agent': 'nix-mail2discord/2.5'}
-    req = urllib.request.Request(WEBHOOK_URL, data=data, headers=headers)
+
+def embed_length(embed):
+    """Characters Discord counts towards the 6000 per-message embed total."""
+    return len(embed["title"]) + len(embed["description"]) + len(embed["footer"]["text"])
+
+# --- Rate limits ---
+
+def route_key():
+    # The webhook URL contains its token; only a digest goes into the state file
+    return hashlib.sha256((WEBHOOK_URL or "").encode()).hexdigest()[:16]
+
+def _sane_state(state):
+    """Keep only well-formed values; any local user can write the state file."""
+    def number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if not isinstance(state, dict):
+        return {}
+    routes = state.get("routes")
+    clean = {"routes": {
+        key: {k: v for k, v in route.items() if k == "bucket" or number(v)}
+        for key, route in (routes.items() if isinstance(routes, dict) else ())
+        if isinstance(route, dict)
+    }}
+    if number(state.get("global_reset_at")):
+        clean["global_reset_at"] = state["global_reset_at"]
+    return clean
+
+@contextlib.contextmanager
+def ratelimit_state():
+    """Yield the shared rate-limit state under an exclusive lock; saved on exit.
+
+    Best effort: if the file can't be used, an empty throwaway state is yielded.
+    """
+    try:
+        fd = os.open(RATELIMIT_FILE, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    except OSError:
+        yield {}
+        return
+    with os.fdopen(fd, "r+", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            state = json.loads(f.read() or "{}")
+        except ValueError:
+            state = {}
+        state = _sane_state(state)
+        yield state
+        now = time.time()
+        # Drop buckets whose window has long passed
+        state["routes"] = {k: v for k, v in state.get("routes", {}).items() if v.get("reset_at", 0) > now - 3600}
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+
+def wait_for_slot():
+    """Block until the shared state says a request may go out, and reserve it."""
+    while True:
+        with ratelimit_state() as state:
+            now = time.time()
+            route = state.setdefault("routes", {}).get(route_key())
+            wait = state.get("global_reset_at", 0) - now
+            if wait <= 0:
+                if not route or route.get("reset_at", 0) <= now:
+                    return
+                if route.get("remaining", 1) > 0:
+                    # Remaining may never have been reported for this bucket
+                    route["remaining"] = route.get("remaining", 1) - 1
+                    return
+                wait = route["reset_at"] - now
+        wait = min(wait, MAX_RATELIMIT_WAIT)
+        print(f"Pacing for Discord rate limit: {wait:.2f}s", file=sys.stderr)
+        time.sleep(wait + 0.05)
+
+def record_ratelimit(headers, retry_after=None):
+    """Update the shared state from a response's X-RateLimit-* headers."""
+    if headers is None:
+        return
+    try:
+        with ratelimit_state() as state:
+            now = time.time()
+            if retry_after is not None and str(headers.get("X-RateLimit-Global", "")).lower() == "true":
+                state["global_reset_at"] = now + min(retry_after, MAX_RATELIMIT_WAIT)
+                return
+            routes = state.setdefault("routes", {})
+            route = routes.get(route_key(), {})
+            if headers.get("X-RateLimit-Bucket"):
+                route["bucket"] = headers["X-RateLimit-Bucket"]
+            if headers.get("X-RateLimit-Limit"):
+                route["limit"] = int(headers["X-RateLimit-Limit"])
+            if headers.get("X-RateLimit-Remaining") is not None:
+                route["remaining"] = int(headers["X-RateLimit-Remaining"])
+            if headers.get("X-RateLimit-Reset-After") is not None:
+                route["reset_at"] = now + min(float(headers["X-RateLimit-Reset-After"]), MAX_RATELIMIT_WAIT)
+            if retry_after is not None:
+                route["remaining"] = 0
+                route["reset_at"] = max(route.get("reset_at", 0), now + min(retry_after, MAX_RATELIMIT_WAIT))
+            if route:
+                routes[route_key()] = route
+    except ValueError:
+        pass
+
+# --- Attachments ---
+
+def _quote(value):
+    return value.replace("\\", "_").replace('"', "_").replace("\r", "_").replace("\n", "_")
+
+def multipart_body(payload, files, boundary):
+    """Describe a multipart/form-data body without building it in memory.
+
+    files are dicts with filename, content_type and either fh (an open
+    file, streamed) or data (bytes). Returns (content_length, make_chunks);
+    each call of make_chunks() yields the body afresh, so retries can resend it.
+    """
+    parts = [(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="payload_json"\r\n'
+        f'Content-Type: application/json\r\n\r\n'.encode(),
+        json.dumps(payload).encode('utf-8'),
+    )]
+    for index, f in enumerate(files):
+        header = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="files[{index}]"; '
+            f'filename="{_quote(f["filename"])}"\r\nContent-Type: {f["content_type"]}\r\n\r\n'
+        ).encode()
+        parts.append((header, f["fh"] if "fh" in f else f["data"]))
+    closing = f"--{boundary}--\r\n".encode()
+
+    sizes = [len(source) if isinstance(source, bytes) else os.fstat(source.fileno()).st_size
+             for _, source in parts]
+    length = sum(len(header) + size + 2 for (header, _), size in zip(parts, sizes)) + len(closing)
+
+    def make_chunks():
+        for (header, source), size in zip(parts, sizes):
+            yield header
+            if isinstance(source, bytes):
+                yield source
+            else:
+                # Never send more than Content-Length promised
+                source.seek(0)
+                while size > 0 and (chunk := source.read(min(CHUNK_SIZE, size))):
+                    size -= len(chunk)
+                    yield chunk
+            yield b"\r\n"
+        yield closing
+
+    return length, make_chunks
+
+def attachment_size(f):
+    if "data" in f:
+        return len(f["data"])
+    if "fh" in f:
+        return os.fstat(f["fh"].fileno()).st_size
+    return os.lstat(f["path"]).st_size
+
+def open_attachments(files):
+    """Open spooled attachments for upload without following symlinks.
+
+    Each must still be a regular file owned by the user who queued the
+    entry; raises ValueError or OSError otherwise.
+    """
+    opened = []
+    try:
+        for f in files:
+            if "path" not in f:
+                opened.append(f)
+                continue
+            fh = os.fdopen(os.open(f["path"], os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK), "rb")
+            opened.append({**f, "fh": fh})
+            st = os.fstat(fh.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != f["owner"]:
+                raise ValueError(f"{f['path']} is not a regular file owned by the sender")
+    except BaseException:
+        close_attachments(opened)
+        raise
+    return opened
+
+def close_attachments(files):
+    for f in files:
+        if "fh" in f:
+            f["fh"].close()
+
+def limit_attachments(files):
+    """Keep what Discord will accept; returns (kept, skipped filenames)."""
+    kept, skipped, total = [], [], 0
+    for f in files:
+        size = attachment_size(f)
+        if len(kept) >= MAX_ATTACHMENTS or total + size > MAX_UPLOAD_BYTES:
+            skipped.append(f["filename"])
+            continue
+        kept.append(f)
+        total += size
+    return kept, skipped
+
+def preview_body(body):
+    """First lines of a long body for the embed; the full text is attached."""
+    lines = body.splitlines()[:PREVIEW_LINES]
+    preview = "\n".join(lines)[:MAX_BODY_LEN - 100]
+    return preview + f"\n... [full message attached as {BODY_ATTACHMENT}]"
+
+# --- HTTP client ---
+
+_connection = None
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+def _connect(url):
+    """Open a connection to the webhook host; the timeout covers TCP and TLS setup."""
+    if url.scheme == "https":
+        conn = http.client.HTTPSConnection(url.hostname, url.port, timeout=CONNECT_TIMEOUT,
+                                           context=ssl.create_default_context())
+    else:
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=CONNECT_TIMEOUT)
+    conn.connect()
+    conn.sock.settimeout(READ_TIMEOUT)
+    return conn
+
+def http_post(make_body, headers):
+    """POST to the webhook over the shared keep-alive connection.
+
+    make_body() returns the request body (called again if it has to be
+    resent). Returns (status, reason, headers, body). A reused connection
+    that the server already closed is reopened once, transparently; other
+    socket errors and timeouts raise OSError or http.client.HTTPException.
+    """
+    global _connection
+    url = urllib.parse.urlsplit(WEBHOOK_URL)
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    for reused in (True, False):
+        fresh = _connection is None
+        if fresh:
+            _connection = _connect(url)
+        try:
+            _connection.request("POST", path, body=make_body(), headers=headers)
+            response = _connection.getresponse()
+            # Drain the body so the connection can carry the next request
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            close_connection()
+            # Idle keep-alive closed by the server: nothing was processed, reconnect
+            if fresh or not reused:
+                raise
+            continue
+        except BaseException:
+            close_connection()
+            raise
+        if response.will_close:
+            close_connection()
+        return response.status, response.reason, response.headers, body
+
+def post_payload(payload, max_retries=5, files=()):
+    """POST a webhook payload, retrying 429/5xx/network errors. Raises DeliveryError.
+
+    With files, the payload goes out as multipart/form-data with the files
+    streamed as attachments.
+    """
+    if not WEBHOOK_URL:
+        raise DeliveryError("No Webhook URL found.")
+
+    headers = {'User-Agent': 'nix-mail2discord/2.5'}
+    if files:
+        boundary = f"mail2discord-{os.urandom(12).hex()}"
+        length, make_body = multipart_body(payload, files, boundary)
+        headers['Content-Type'] = f"multipart/form-data; boundary={boundary}"
+    else:
+        data = json.dumps(payload).encode('utf-8')
+        length, make_body = len(data), lambda: data
+        headers['Content-Type'] = 'application/json'
+    headers['Content-Length'] = str(length)
 
     # 3. Retry Logic
-    max_retries = 5
     for attempt in range(max_retries):
+        wait_for_slot()
         try:
-            with urllib.request.urlopen(req) as response:
-                return # Success
-        except urllib.error.HTTPError as e:
-            if e.code == 429:
-                # Rate limited - Respect Retry-After
-                retry_after = 2.0
+            status, reason, response_headers, body = http_post(make_body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            sleep_time = 2 ** attempt
+            print(f"Network error: {e or type(e).__name__}. Retrying in {sleep_time}s...", file=sys.stderr)
+            time.sleep(sleep_time)
+            continue
+
+        if status < 300:
+            record_ratelimit(response_headers)
+            return # Success
+
+        if status == 429:
+            # Rate limited - Respect Retry-After
+            retry_after = 2.0
+            try:
+                reply = json.loads(body.decode())
+                if isinstance(reply, dict) and 'retry_after' in reply:
+                     retry_after = float(reply['retry_after'])
+            except Exception:
+                header_val = response_headers.get('Retry-After')
+                if header_val: retry_after = float(header_val)
+
+            # Tell the other processes too, but never depend on the shared
+            # state to do the waiting: it may be unavailable to this sender
+            print(f"Rate limited (429). Backing off {retry_after:.2f}s...", file=sys.stderr)
+            record_ratelimit(response_headers, retry_after)
+            time.sleep(min(retry_after, MAX_RATELIMIT_WAIT))
+            continue
+
+        record_ratelimit(response_headers)
+        if 500 <= status < 600:
+            sleep_time = 2 ** attempt
+            print(f"Server error {status}. Retrying in {sleep_time}s...", file=sys.stderr)
+            time.sleep(sleep_time)
+            continue
+
+        # 400 Bad Request usually means payload too big or invalid JSON
+        if status == 400:
+            print(f"DEBUG: 400 Error. Payload Size: {length}", file=sys.stderr)
+        raise DeliveryError(f"Discord API Error: {status} {reason}", permanent=True)
+
+    raise DeliveryError("Max retries exceeded.")
+
+def send_to_discord(subject, sender, body, attachments=()):
+    """Deliver inline; used when the spool is unavailable."""
+    if not WEBHOOK_URL:
+        print("ERR: No Webhook URL found.", file=sys.stderr)
+        return
+    files = [{"filename": name, "content_type": ctype, "data": data} for name, ctype, data in attachments]
+    if len(body) > MAX_BODY_LEN:
+        files.insert(0, {"filename": BODY_ATTACHMENT, "content_type": "text/plain; charset=utf-8", "data": body.encode('utf-8')})
+        body = preview_body(body)
+    files, skipped = limit_attachments(files)
+    attached = [f["filename"] for f in files] + [f"{name} (skipped, too large)" for name in skipped]
+    try:
+        post_payload(build_payload(subject, sender, body, attached=attached), files=files)
+    except DeliveryError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(69)
+
+# --- Spool ---
+
+def _write_spool_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+    # Group-readable regardless of umask: the setgid spool gives the file to
+    # the worker's group
+    os.fchmod(fd, 0o640)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def enqueue(subject, sender, body, spool=None, attachments=()):
+    """Write a message into the spool atomically. Returns its path.
+
+    Attachments, and the full text of a long body, are stored as sibling
+    <name>.<n>.att files, moved into new/ before the JSON entry itself.
+    """
+    spool = spool or SPOOL_DIR
+    files = list(attachments)
+    if len(body) > MAX_BODY_LEN:
+        files.insert(0, (BODY_ATTACHMENT, "text/plain; charset=utf-8", body.encode('utf-8')))
+        body = preview_body(body)
+    # Sortable by arrival so delivery keeps mail order
+    base = f"{time.time_ns():020d}.{os.getpid()}.{os.urandom(4).hex()}"
+    message = {
+        "subject": subject,
+        "sender": sender,
+        "body": body,
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "attachments": [
+            {"filename": name, "content_type": ctype, "file": f"{base}.{index}.att"}
+            for index, (name, ctype, _) in enumerate(files)
+        ],
+    }
+    names = [f"{base}.{index}.att" for index in range(len(files))] + [f"{base}.json"]
+    try:
+        for name, (_, _, data) in zip(names, files):
+            _write_spool_file(os.path.join(spool, "tmp", name), data)
+        _write_spool_file(os.path.join(spool, "tmp", names[-1]), json.dumps(message).encode('utf-8'))
+        # The JSON entry goes last: the worker only picks up complete messages
+        for name in names:
+            os.rename(os.path.join(spool, "tmp", name), os.path.join(spool, "new", name))
+    except BaseException:
+        for name in names:
+            for folder in ("tmp", "new"):
                 try:
-                    body = json.loads(e.read().decode())
-                    if isinstance(body, dict) and 'retry_after' in body:
-                         retry_after = float(body['retry_after'])
-                except Exception:
-                    header_val = e.headers.get('Retry-After')
-                    if header_val: retry_after = float(header_val)
-
-                print(f"Rate limited (429). Sleeping {retry_after:.2f}s...", file=sys.stderr)
-                time.sleep(retry_after + 0.1)
-                continue
-            
-            elif 500 <= e.code < 600:
-                sleep_time = 2 ** attempt
-                print(f"Server error {e.code}. Retrying in {sleep_time}s...", file=sys.stderr)
-                time.sleep(sleep_time)
+                    os.unlink(os.path.join(spool, folder, name))
+                except FileNotFoundError:
+                    pass
+        raise
+    return os.path.join(spool, "new", names[-1])
+
+def entry_files(path):
+    """A spool entry's JSON file plus its attachment files."""
+    return glob.glob(glob.escape(path[:-len(".json")]) + ".*.att") + [path]
+
+def load_entry(path):
+    """Read and validate a spool entry. Raises OSError or ValueError.
+
+    Every local user can write to new/, so nothing in an entry is trusted:
+    fields must have the expected types, and attachments must be this
+    entry's own <base>.<n>.att files, regular and owned by whoever wrote
+    the entry. The owner is kept as message["owner"].
+    """
+    with os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK), "rb") as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError("not a regular file")
+        data = f.read(MAX_ENTRY_BYTES + 1)
+    if len(data) > MAX_ENTRY_BYTES:
+        raise ValueError("entry too large")
+    message = json.loads(data)
+    if not isinstance(message, dict):
+        raise ValueError("not a JSON object")
+    for field in ("subject", "sender", "body"):
+        if not isinstance(message.get(field), str):
+            raise ValueError(f"missing or invalid {field}")
+    if not isinstance(message.get("timestamp", ""), str):
+        raise ValueError("invalid timestamp")
+
+    attachments = message.get("attachments") or []
+    if not isinstance(attachments, list):
+        raise ValueError("invalid attachments")
+    base = os.path.basename(path)[:-len(".json")]
+    for index, a in enumerate(attachments):
+        if not isinstance(a, dict) or a.get("file") != f"{base}.{index}.att" or not isinstance(a.get("filename"), str):
+            raise ValueError(f"invalid attachment {index}")
+        if not isinstance(a.get("content_type"), str) or not CONTENT_TYPE_RE.fullmatch(a["content_type"]):
+            a["content_type"] = "application/octet-stream"
+        att = os.lstat(os.path.join(os.path.dirname(path), a["file"]))
+        if not stat.S_ISREG(att.st_mode) or att.st_uid != st.st_uid:
+            raise ValueError(f"attachment {a['file']} is not a regular file owned by the sender")
+    message["attachments"] = attachments
+    message["owner"] = st.st_uid
+    return message
+
+def spooled_messages(spool):
+    new_dir = os.path.join(spool, "new")
+    try:
+        names = sorted(n for n in os.listdir(new_dir) if n.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(new_dir, n) for n in names]
+
+def coalesce(entries):
+    """Group spool entries with identical subject and body, in first-seen order."""
+    groups = {}
+    for path, message in entries:
+        # Messages with files are never merged
+        key = path if message.get("attachments") else (message["subject"], message["body"])
+        group = groups.get(key)
+        if group is None:
+            groups[key] = {"message": message, "paths": [path], "last": message.get("timestamp")}
+        else:
+            group["paths"].append(path)
+            group["last"] = message.get("timestamp")
+    return list(groups.values())
+
+def pack(groups):
+    """Split groups into webhook posts of at most 10 embeds and 6000 characters.
+
+    Yields (groups, payload, files) triples; a message with attachments
+    always travels alone. Bodies are never shortened to make embeds fit: a
+    post closes when the next embed would not fit whole, and a body over
+    the embed limit goes up in full as an attachment.
+    """
+    batch, embeds, total = [], [], 0
+    for group in groups:
+        message = group["message"]
+        if len(message["body"]) > MAX_BODY_LEN and not message.get("attachments"):
+            # Queued before enqueue() split long bodies out
+            if batch:
+                yield batch, {"username": "Smartd", "embeds": embeds}, []
+                batch, embeds, total = [], [], 0
+            body = message["body"]
+            embed = build_embed(message["subject"], message["sender"], preview_body(body),
+                                group["last"], count=len(group["paths"]), attached=[BODY_ATTACHMENT])
+            files = [{"filename": BODY_ATTACHMENT, "content_type": "text/plain; charset=utf-8", "data": body.encode('utf-8')}]
+            yield [group], {"username": "Smartd", "embeds": [embed]}, files
+            continue
+        if message.get("attachments"):
+            if batch:
+                yield batch, {"username": "Smartd", "embeds": embeds}, []
+                batch, embeds, total = [], [], 0
+            folder = os.path.dirname(group["paths"][0])
+            # Names and owner were checked by load_entry; open_attachments checks again
+            files = [
+                {"filename": a["filename"], "content_type": a["content_type"],
+                 "path": os.path.join(folder, a["file"]), "owner": message["owner"]}
+                for a in message["attachments"]
+            ]
+            files, skipped = limit_attachments(files)
+            attached = [f["filename"] for f in files] + [f"{name} (skipped, too large)" for name in skipped]
+            embed = build_embed(message["subject"], message["sender"], message["body"],
+                                group["last"], attached=attached)
+            yield [group], {"username": "Smartd", "embeds": [embed]}, files
+            continue
+        embed = build_embed(message["subject"], message["sender"], message["body"],
+                            group["last"], count=len(group["paths"]))
+        size = embed_length(embed)
+        if batch and (len(embeds) == LIMIT_EMBEDS or total + size > LIMIT_EMBED_TOTAL):
+            yield batch, {"username": "Smartd", "embeds": embeds}, []
+            batch, embeds, total = [], [], 0
+        batch.append(group)
+        embeds.append(embed)
+        total += size
+    if batch:
+        yield batch, {"username": "Smartd", "embeds": embeds}, []
+
+def clean_spool(spool):
+    """Remove stale tmp/ files and attachments in new/ whose entry never arrived."""
+    cutoff = time.time() - STALE_AGE
+    new_dir = os.path.join(spool, "new")
+    for folder in ("tmp", "new"):
+        directory = os.path.join(spool, folder)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            if folder == "new":
+                # Only attachments can be orphaned; entries are delivered or failed
+                if not name.endswith(".att"):
+                    continue
+                if os.path.exists(os.path.join(new_dir, name.rsplit(".", 2)[0] + ".json")):
+                    continue
+            try:
+                if os.lstat(path).st_mtime < cutoff:
+                    print(f"Removing stale spool file {path}", file=sys.stderr)
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+def deliver_spool(spool=None, window=None):
+    """Drain the spool in arrival order. Returns an exit status.
+
+    Queued mail is coalesced (identical subject and body become one embed
+    with a count) and packed into multi-embed posts. Delivered messages are
+    removed; permanently rejected or unreadable ones are moved to failed/.
+    A transient failure stops the run with EX_TEMPFAIL and leaves the rest
+    queued for the next run.
+    """
+    spool = spool or SPOOL_DIR
+    window = BATCH_WINDOW if window is None else window
+    failed_dir = os.path.join(spool, "failed")
+    os.makedirs(failed_dir, exist_ok=True)
+
+    def fail(path):
+        for name in entry_files(path):
+            os.replace(name, os.path.join(failed_dir, os.path.basename(name)))
+
+    with open(os.path.join(spool, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is draining
+            return 0
+
+        clean_spool(spool)
+
+        if window > 0 and spooled_messages(spool):
+            time.sleep(window)
+
+        entries = []
+        for path in spooled_messages(spool):
+            try:
+                message = load_entry(path)
+            except (OSError, ValueError) as e:
+                print(f"Unreadable spool entry {path}: {e}", file=sys.stderr)
+                fail(path)
                 continue
-            
+            entries.append((path, message))
+
+        return deliver_groups(coalesce(entries), fail)
+
+def deliver_groups(groups, fail, isolate=True):
+    for batch, payload, files in pack(groups):
+        try:
+            files = open_attachments(files)
+        except (OSError, ValueError) as e:
+            print(f"Rejected spool entry {batch[0]['paths'][0]}: {e}", file=sys.stderr)
+            for group in batch:
+                for path in group["paths"]:
+                    fail(path)
+            continue
+        try:
+            post_payload(payload, files=files)
+        except DeliveryError as e:
+            print(f"{len(payload['embeds'])} embed(s): {e}", file=sys.stderr)
+            if not e.permanent:
+                return EX_TEMPFAIL
+            if isolate and len(batch) > 1:
+                # Find the offending message by sending each group on its own
+                for group in batch:
+                    status = deliver_groups([group], fail, isolate=False)
+                    if status:
+                        return status
             else:
-                # 400 Bad Request usually means payload too big or invalid JSON
-                if e.code == 400:
-                    print(f"DEBUG: 400 Error. Payload Size: {len(data)}", file=sys.stderr)
-                print(f"Discord API Error: {e.code} {e.reason}", file=sys.stderr)
-                sys.exit(69)
-                
-        except urllib.error.URLError as e:
-             sleep_time = 2 ** attempt
-             print(f"Network error: {e.reason}. Retrying in {sleep_time}s...", file=sys.stderr)
-             time.sleep(sleep_time)
-             continue
-
-    print("Max retries exceeded.", file=sys.stderr)
-    sys.exit(69)
+                for group in batch:
+                    for path in group["paths"]:
+                        fail(path)
+            continue
+        finally:
+            close_attachments(files)
+        for group in batch:
+            for path in group["paths"]:
+                for name in entry_files(path):
+                    os.unlink(name)
+    return 0
+
+class _TextExtractor(HTMLParser):
+    """Cheap HTML to text: keep the visible text, break lines at block elements."""
+
+    BLOCK_TAGS = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "table", "hr"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+        elif tag == "td":
+            self.chunks.append("\t")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.chunks.append(data)
+
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    lines = (" ".join(line.split()) for line in "".join(parser.chunks).splitlines())
+    # Collapse the blank runs that nested block elements leave behind
+    text, blank = [], False
+    for line in lines:
+        if line or not blank:
+            text.append(line)
+        blank = not line
+    return "\n".join(text).strip()
+
+def _decode(part):
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ""
+    return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
 
 def extract_body(msg):
     text = ""
+    html = ""
     if msg.is_multipart():
         for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                payload = part.get_payload(decode=True)
-                if payload:
-                    text = payload.decode('utf-8', 'replace')
+            if part.is_multipart() or part.is_attachment():
+                continue
+            if part.get_content_type() == "text/plain" and not text:
+                text = _decode(part)
+                if text:
                     break
+            elif part.get_content_type() == "text/html" and not html:
+                html = _decode(part)
     else:
         payload = msg.get_payload(decode=True)
         if payload:
             text = payload.decode('utf-8', 'replace')
         else:
             text = str(msg.get_payload())
+        if msg.get_content_type() == "text/html":
+            html, text = text, ""
+    if not text and html:
+        text = html_to_text(html)
     return text or "No readable text content."
 
+def extract_attachments(msg):
+    """Non-text parts and explicit attachments as (filename, content_type, bytes)."""
+    attachments = []
+    if not msg.is_multipart():
+        return attachments
+    for index, part in enumerate(msg.walk()):
+        if part.is_multipart():
+            continue
+        if not part.is_attachment() and part.get_content_maintype() == "text":
+            continue
+        data = part.get_payload(decode=True)
+        if not data:
+            continue
+        ctype = part.get_content_type()
+        filename = part.get_filename() or f"part{index}{mimetypes.guess_extension(ctype) or '.bin'}"
+        attachments.append((os.path.basename(filename), ctype, data))
+    return attachments
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", action="store_true")
     parser.add_argument("-i", action="store_true")
     parser.add_argument("-f", help="sender")
+    parser.add_argument("--deliver", action="store_true", help="drain the spool instead of reading a message")
+    parser.add_argument("--window", type=float, help="with --deliver: seconds to let a burst accumulate before posting")
     parser.add_argument("recipients", nargs="*")
     args, unknown = parser.parse_known_args()
 
-    load_secret()
+    if args.deliver:
+        load_secret()
+        try:
+            status = deliver_spool(window=args.window)
+        finally:
+            close_connection()
+        sys.exit(status)
 
     try:
         raw_email = sys.stdin.buffer.read()
@@ -157,8 +859,16 @@ def main():
     subject = msg.get("subject", "No Subject").replace('`', '')
     sender = msg.get("from", "Unknown Sender").replace('`', '')
     body = extract_body(msg).strip()
+    attachments = extract_attachments(msg)
 
-    send_to_discord(subject, sender, body)
+    try:
+        enqueue(subject, sender, body, attachments=attachments)
+        return
+    except OSError as e:
+        print(f"Spool unavailable ({e}); delivering inline.", file=sys.stderr)
+
+    load_secret()
+    send_to_discord(subject, sender, body, attachments)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -9,6 +9,12 @@ python3Packages.buildPythonApplication {
 
   src = ./.;
 
+  # Optional codecs (services.qbt-backup.compression = "zstd" / "lz4")
+  propagatedBuildInputs = with python3Packages; [
+    zstandard
+    lz4
+  ];
+
   installPhase = ''
     install -Dm755 qbt_backup.py $out/bin/qbt-backup
   '';
@@ -1,9 +1,26 @@
 #!/usr/bin/env python3
 import os
+import re
+import sys
+import gzip
+import json
+import stat
+import fcntl
 import shutil
+import hashlib
 import tarfile
+import sqlite3
 import logging
-from datetime import datetime
+import argparse
+import tempfile
+import subprocess
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import monotonic, sleep
+from datetime import datetime, timedelta
 from glob import glob
 
 # ==========================================
@@ -20,9 +37,22 @@ BACKUP_ROOT = os.environ.get("QBT_BACKUP_ROOT", "/mnt/hdd-pool/main/Backups/qBit
 MOUNT_POINT_TO_CHECK = os.environ.get("QBT_MOUNT_POINT", "/mnt/hdd-pool/main")
 
 # --- COMPRESSION SETTINGS ---
-# 1 (Fastest) to 9 (Smallest). 6 is the standard balance.
+# Archive codec: "gzip", "zstd" (multi-threaded, long-distance matching), "lz4" or "none".
+COMPRESSION = os.environ.get("QBT_COMPRESSION", "gzip").lower()
+
+# Codec level. gzip: 1 (Fastest) to 9 (Smallest), zstd: 1-19, lz4: 0-16.
+# 6 is the standard balance for gzip and a sensible default for the others.
 COMPRESSION_LEVEL = int(os.environ.get("QBT_COMPRESSION_LEVEL", 6))
 
+# zstd worker threads per archive. 0 = one per CPU core.
+COMPRESSION_THREADS = int(os.environ.get("QBT_COMPRESSION_THREADS", 0))
+
+# --- BACKUP MODE ---
+# "archive": write a full compressed tarball per run.
+# "incremental": store file contents in a per-instance blob store keyed by SHA-256
+# and write a small manifest per run. Only new or changed files are read and stored.
+BACKUP_MODE = os.environ.get("QBT_BACKUP_MODE", "archive").lower()
+
 # --- HOURLY SETTINGS ---
 ENABLE_HOURLY = os.environ.get("QBT_ENABLE_HOURLY", "True").lower() == "true"
 KEEP_HOURLY   = int(os.environ.get("QBT_KEEP_HOURLY", 24))
@@ -39,22 +69,134 @@ KEEP_WEEKLY   = int(os.environ.get("QBT_KEEP_WEEKLY", 4))
 ENABLE_MONTHLY = os.environ.get("QBT_ENABLE_MONTHLY", "True").lower() == "true"
 KEEP_MONTHLY   = int(os.environ.get("QBT_KEEP_MONTHLY", 6))
 
+# --- AGE AND SIZE LIMITS ---
+# Optional caps applied on top of the keep counts.
+# Maximum age per tier, with a unit: "36h", "14d", "8w". Empty = no limit.
+MAX_AGE_HOURLY  = os.environ.get("QBT_MAX_AGE_HOURLY", "")
+MAX_AGE_DAILY   = os.environ.get("QBT_MAX_AGE_DAILY", "")
+MAX_AGE_WEEKLY  = os.environ.get("QBT_MAX_AGE_WEEKLY", "")
+MAX_AGE_MONTHLY = os.environ.get("QBT_MAX_AGE_MONTHLY", "")
+
+# Byte budgets (0 = unlimited). The oldest backups are pruned first and the
+# newest backup of every instance is always kept.
+MAX_BYTES_PER_INSTANCE = int(os.environ.get("QBT_MAX_BYTES_PER_INSTANCE", 0))
+MAX_BYTES_TOTAL        = int(os.environ.get("QBT_MAX_BYTES_TOTAL", 0))
+
 # --- PROMOTION SCHEDULING ---
 # If set to 0-23, daily/weekly/monthly promotions will ONLY happen during that hour.
 # Defaults to -1 (disabled -> promote on first run of the period).
 PROMOTION_HOUR = int(os.environ.get("QBT_PROMOTION_HOUR", -1))
 
+# --- PROMOTION METHOD ---
+# How a finished backup is placed into each retention folder.
+# "auto" tries a hardlink, then a reflink (FICLONE), then a full copy.
+# "hardlink" / "reflink" force one method; both still fall back to copying.
+PROMOTION_METHOD = os.environ.get("QBT_PROMOTION_METHOD", "auto").lower()
+
+# --- PARALLELISM ---
+# Number of instances archived at the same time (separate processes, since
+# compression is CPU-bound). 1 keeps the classic one-after-another behaviour.
+WORKERS = max(1, int(os.environ.get("QBT_WORKERS", 1)))
+
+# --- CHANGE DETECTION ---
+# Fingerprint each instance (paths, sizes, mtimes, inodes) before archiving.
+# If nothing changed since the last backup, that backup is promoted instead
+# of compressing the same data again. Not used for "api" capture: pausing
+# makes qBittorrent rewrite its resume data, so those instances always differ.
+SKIP_UNCHANGED = os.environ.get("QBT_SKIP_UNCHANGED", "True").lower() == "true"
+
+# --- SNAPSHOT CAPTURE ---
+# Archive from a frozen view of each instance instead of the live directory:
+#   "none"  - read the live directory (classic behaviour)
+#   "btrfs" - read-only snapshot of the btrfs subvolume holding the instance
+#   "zfs"   - snapshot of the ZFS dataset holding the instance
+#   "api"   - pause torrents via the local qBittorrent WebUI API (qBittorrent
+#             writes out resume data), copy the state aside, resume at once
+# QBT_CAPTURE overrides the default per instance: "main=btrfs,seedbox=api"
+CAPTURE_DEFAULT = os.environ.get("QBT_CAPTURE_DEFAULT", "none").lower()
+CAPTURE = os.environ.get("QBT_CAPTURE", "")
+
+# WebUI base URL per instance for "api" capture: "main=http://127.0.0.1:8080,..."
+API_URLS = os.environ.get("QBT_API_URLS", "")
+# Only needed if the WebUI does not bypass authentication for localhost
+API_USERNAME = os.environ.get("QBT_API_USERNAME", "")
+API_PASSWORD_FILE = os.environ.get("QBT_API_PASSWORD_FILE", "")
+# Seconds to let qBittorrent finish writing resume data after pausing
+API_SETTLE_SECONDS = float(os.environ.get("QBT_API_SETTLE_SECONDS", 2))
+
 # ==========================================
 # END CONFIGURATION
 # ==========================================
 
 RETENTION = {
-    'hourly':  {'enabled': ENABLE_HOURLY,  'keep': KEEP_HOURLY},
-    'daily':   {'enabled': ENABLE_DAILY,   'keep': KEEP_DAILY},
-    'weekly':  {'enabled': ENABLE_WEEKLY,  'keep': KEEP_WEEKLY},
-    'monthly': {'enabled': ENABLE_MONTHLY, 'keep': KEEP_MONTHLY}
+    'hourly':  {'enabled': ENABLE_HOURLY,  'keep': KEEP_HOURLY,  'max_age': MAX_AGE_HOURLY},
+    'daily':   {'enabled': ENABLE_DAILY,   'keep': KEEP_DAILY,   'max_age': MAX_AGE_DAILY},
+    'weekly':  {'enabled': ENABLE_WEEKLY,  'keep': KEEP_WEEKLY,  'max_age': MAX_AGE_WEEKLY},
+    'monthly': {'enabled': ENABLE_MONTHLY, 'keep': KEEP_MONTHLY, 'max_age': MAX_AGE_MONTHLY}
 }
 
+DURATION_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+CODEC_SUFFIXES = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+    'lz4':  '.tar.lz4',
+    'none': '.tar',
+}
+MANIFEST_SUFFIX = ".manifest.json.gz"
+BACKUP_SUFFIXES = (*CODEC_SUFFIXES.values(), MANIFEST_SUFFIX)
+
+# Manifests and blobs are always gzip; keep the level in gzip's range
+GZIP_LEVEL = min(max(COMPRESSION_LEVEL, 1), 9)
+
+# Same window as `zstd --long`; any zstd decoder reads it without extra flags
+ZSTD_WINDOW_LOG = 27
+
+# Timestamp embedded in every backup filename: <instance>_<timestamp><suffix>
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+TIMESTAMP_RE = re.compile(r"_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.")
+
+PROMOTION_METHODS = {
+    'auto':     ('hardlink', 'reflink', 'copy'),
+    'hardlink': ('hardlink', 'copy'),
+    'reflink':  ('reflink', 'copy'),
+    'copy':     ('copy',),
+}
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Backup catalog (one per backup root): instance, tier, logical timestamp,
+# size and checksum of every retained backup.
+CATALOG_PATH = os.path.join(BACKUP_ROOT, "catalog.sqlite3")
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    path     TEXT PRIMARY KEY,  -- relative to BACKUP_ROOT
+    instance TEXT NOT NULL,
+    tier     TEXT NOT NULL,
+    taken_at TEXT NOT NULL,     -- TIMESTAMP_FORMAT, sorts chronologically
+    size     INTEGER NOT NULL,
+    sha256   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_by_tier ON backups (instance, tier, taken_at);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    instance    TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    sha256      TEXT NOT NULL   -- checksum of the backup taken from that state
+);
+"""
+
+# Snapshots and staging copies are named with this prefix and never archived
+SNAPSHOT_PREFIX = ".qbt-snapshot-"
+
+# btrfs always gives the root directory of a subvolume this inode number
+BTRFS_SUBVOL_INO = 256
+
+# Incremental mode layout inside <BACKUP_ROOT>/<instance>/
+BLOB_DIR = "blobs"
+LAST_MANIFEST = ".last-manifest.json.gz"
+MANIFEST_VERSION = 1
+
 # Log to stdout for systemd journal integration
 logging.basicConfig(
     level=logging.INFO,
@@ -67,16 +209,25 @@ def is_mount_safe():
         return False
     return os.path.ismount(MOUNT_POINT_TO_CHECK)
 
-def tar_filter(tarinfo):
-    """Exclude useless files and dangerous device nodes."""
-    name = tarinfo.name
-    
+def is_excluded(name):
+    """Path exclusions shared by the tar filter and the incremental walker."""
     # Exclude lock files 
     if name.endswith(".lock") or "qBittorrent.lock" in name:
-        return None
+        return True
         
     # Exclude cache/logs
     if "/cache/" in name or "/logs/" in name:
+        return True
+
+    # Exclude our own in-flight snapshots
+    if f"/{SNAPSHOT_PREFIX}" in name:
+        return True
+
+    return False
+
+def tar_filter(tarinfo):
+    """Exclude useless files and dangerous device nodes."""
+    if is_excluded(tarinfo.name):
         return None
         
     # Exclude special files (character devices, block devices, FIFOs)
@@ -123,100 +274,1194 @@ def should_run_backup(interval, last_backup_time, now):
 
     return False
 
-def clean_old_backups(backup_folder, count):
-    if not os.path.exists(backup_folder):
-        return
-    
-    files = glob(os.path.join(backup_folder, "*.tar.gz"))
-    files = sorted(files, key=os.path.getmtime, reverse=True)
-    
-    if len(files) > count:
-        for f in files[count:]:
+def reflink_file(src, dst):
+    """Share src's extents with a new file at dst (btrfs, XFS, bcachefs...)."""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+def promote_file(src, dest):
+    """
+    Place src at dest as cheaply as the filesystem allows.
+    dest is built under a temp name and renamed, so it never appears half-written.
+    Returns the method that succeeded.
+    """
+    temp_dest = os.path.join(os.path.dirname(dest), f".tmp_{os.getpid()}_{os.path.basename(dest)}")
+    methods = PROMOTION_METHODS.get(PROMOTION_METHOD, PROMOTION_METHODS['auto'])
+
+    try:
+        for method in methods:
+            if os.path.lexists(temp_dest):
+                os.remove(temp_dest)
             try:
-                os.remove(f)
-                logging.info(f"Pruned old backup: {f}")
+                if method == 'hardlink':
+                    os.link(src, temp_dest)
+                elif method == 'reflink':
+                    reflink_file(src, temp_dest)
+                else:
+                    shutil.copy2(src, temp_dest)
+                break
             except OSError as e:
-                logging.error(f"Error deleting {f}: {e}")
+                if method == 'copy':
+                    raise
+                logging.debug(f"{method} not possible for {dest}: {e}")
+
+        os.replace(temp_dest, dest)
+        return method
+
+    finally:
+        if os.path.lexists(temp_dest):
+            try:
+                os.remove(temp_dest)
+            except OSError:
+                pass
+
+# ==========================================
+# COMPRESSION CODECS
+# ==========================================
+
+def _import_codec(module, codec):
+    """Import an optional compression library, with a useful error if it is missing."""
+    try:
+        return __import__(module, fromlist=["_"])
+    except ImportError as e:
+        raise RuntimeError(f"{codec} compression requires the Python module '{module}'") from e
+
+def codec_for(path):
+    """Codec of an archive, from its filename."""
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if path.endswith(suffix):
+            return codec
+    raise ValueError(f"Unknown archive type: {path}")
+
+class HashingWriter:
+    """File wrapper that checksums everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def writable(self):
+        return True
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextmanager
+def compressed_writer(raw, codec):
+    """Writable stream that compresses into the file object raw as data arrives."""
+    if codec == 'gzip':
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL) as out:
+            yield out
+    elif codec == 'zstd':
+        zstandard = _import_codec("zstandard", codec)
+        params = zstandard.ZstdCompressionParameters.from_level(
+            COMPRESSION_LEVEL,
+            threads=COMPRESSION_THREADS or -1,
+            enable_ldm=True,
+            window_log=ZSTD_WINDOW_LOG,
+        )
+        compressor = zstandard.ZstdCompressor(compression_params=params)
+        with compressor.stream_writer(raw, closefd=False) as out:
+            yield out
+    elif codec == 'lz4':
+        lz4_frame = _import_codec("lz4.frame", codec)
+        with lz4_frame.LZ4FrameFile(raw, mode="wb", compression_level=COMPRESSION_LEVEL) as out:
+            yield out
+    elif codec == 'none':
+        yield raw
+    else:
+        raise ValueError(f"Unknown compression: {codec}")
+
+class HashingReader:
+    """File wrapper that checksums everything read through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def drain(self):
+        """Hash whatever the decompressor left unread and return the digest."""
+        while self.read(1024 * 1024):
+            pass
+        return self.sha256.hexdigest()
+
+@contextmanager
+def compressed_reader(raw, codec):
+    """Readable stream of the decompressed content of the file object raw."""
+    if codec == 'gzip':
+        with gzip.GzipFile(fileobj=raw, mode="rb") as stream:
+            yield stream
+    elif codec == 'zstd':
+        zstandard = _import_codec("zstandard", codec)
+        with zstandard.ZstdDecompressor().stream_reader(raw, closefd=False) as stream:
+            yield stream
+    elif codec == 'lz4':
+        lz4_frame = _import_codec("lz4.frame", codec)
+        with lz4_frame.LZ4FrameFile(raw, mode="rb") as stream:
+            yield stream
+    else:
+        yield raw
+
+def read_archive(path, extract_to=None):
+    """
+    Stream an archive once: decompress every member (extracting it if asked)
+    and checksum the stored bytes on the way. Returns the SHA-256 of the file.
+    """
+    with open(path, "rb") as raw:
+        hashed = HashingReader(raw)
+        with compressed_reader(hashed, codec_for(path)) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                if extract_to:
+                    tar.extractall(extract_to, filter="tar")
+                else:
+                    for member in tar:
+                        if member.isfile():
+                            content = tar.extractfile(member)
+                            while content.read(1024 * 1024):
+                                pass
+            # Read to the end so the codec's own trailer checks (gzip CRC...) run too
+            while stream.read(1024 * 1024):
+                pass
+        return hashed.drain()
+
+def list_backups(backup_folder):
+    """All finished backups (archives and manifests) in a retention folder."""
+    files = []
+    for suffix in BACKUP_SUFFIXES:
+        files.extend(glob(os.path.join(backup_folder, f"*{suffix}")))
+    return files
 
-def get_latest_backup_time(backup_folder):
-    files = glob(os.path.join(backup_folder, "*.tar.gz"))
-    if not files:
+def parse_backup_time(path):
+    """Logical timestamp encoded in a backup filename, or None."""
+    match = TIMESTAMP_RE.search(os.path.basename(path))
+    if not match:
         return None
-    latest = max(files, key=os.path.getmtime)
-    return datetime.fromtimestamp(os.path.getmtime(latest))
+    return datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+
+# ==========================================
+# BACKUP CATALOG
+# ==========================================
+
+def open_catalog():
+    """Open the catalog for BACKUP_ROOT. Safe to use from several processes."""
+    os.makedirs(BACKUP_ROOT, exist_ok=True)
+    created = not os.path.exists(CATALOG_PATH)
+
+    catalog = sqlite3.connect(CATALOG_PATH, timeout=60)
+    catalog.execute("PRAGMA journal_mode=WAL")
+    catalog.executescript(CATALOG_SCHEMA)
+
+    # First use against an existing backup root: adopt the backups already there
+    if created:
+        logging.info("No backup catalog yet, indexing existing backups...")
+        reindex_catalog(catalog)
+    return catalog
+
+def catalog_path(rel_path):
+    return os.path.join(BACKUP_ROOT, rel_path)
+
+def record_backup(catalog, path, instance_name, interval, taken_at, size, sha256):
+    with catalog:
+        catalog.execute(
+            "INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?)",
+            (os.path.relpath(path, BACKUP_ROOT), instance_name, interval, taken_at, size, sha256),
+        )
+
+def reindex_catalog(catalog):
+    """Rebuild the catalog from the backups on disk. Timestamps come from the filenames."""
+    rows = []
+    # Hardlinked tiers share an inode, so each archive is only hashed once
+    checksums = {}
+
+    for instance_name in sorted(os.listdir(BACKUP_ROOT)):
+        dst_base = os.path.join(BACKUP_ROOT, instance_name)
+        if not os.path.isdir(dst_base):
+            continue
+
+        for interval in RETENTION:
+            for path in sorted(list_backups(os.path.join(dst_base, interval))):
+                taken_at = parse_backup_time(path)
+                if taken_at is None:
+                    logging.warning(f"Skipping backup without a timestamp in its name: {path}")
+                    continue
+
+                st = os.stat(path)
+                key = (st.st_dev, st.st_ino)
+                if key not in checksums:
+                    checksums[key] = file_sha256(path)
+
+                rows.append((
+                    os.path.relpath(path, BACKUP_ROOT), instance_name, interval,
+                    taken_at.strftime(TIMESTAMP_FORMAT), st.st_size, checksums[key],
+                ))
+
+    with catalog:
+        catalog.execute("DELETE FROM backups")
+        catalog.executemany("INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    logging.info(f"Reindexed {len(rows)} backups into {CATALOG_PATH}")
+
+def remove_backup(catalog, rel_path):
+    """Delete one backup file and its catalog row. Returns False if the file could not be removed."""
+    f = catalog_path(rel_path)
+    try:
+        os.remove(f)
+        logging.info(f"Pruned old backup: {f}")
+    except FileNotFoundError:
+        logging.warning(f"Backup already gone, dropping from catalog: {f}")
+    except OSError as e:
+        logging.error(f"Error deleting {f}: {e}")
+        return False
+    with catalog:
+        catalog.execute("DELETE FROM backups WHERE path = ?", (rel_path,))
+    return True
+
+def get_latest_backup_time(catalog, instance_name, interval):
+    (latest,) = catalog.execute(
+        "SELECT MAX(taken_at) FROM backups WHERE instance = ? AND tier = ?",
+        (instance_name, interval),
+    ).fetchone()
+    if latest is None:
+        return None
+    return datetime.strptime(latest, TIMESTAMP_FORMAT)
+
+# ==========================================
+# RETENTION PLANNER
+# ==========================================
+
+def parse_duration(value):
+    """ "36h" / "14d" / "8w" -> timedelta; empty -> None."""
+    value = value.strip().lower()
+    if not value:
+        return None
+    if value[-1] not in DURATION_UNITS:
+        raise ValueError(f"Invalid duration {value!r}, expected a number with h, d or w")
+    return timedelta(**{DURATION_UNITS[value[-1]]: float(value[:-1])})
+
+def plan_retention(catalog, now):
+    """
+    Decide everything to prune in one pass over the catalog.
+    Rules, in order: keep count per tier, max age per tier, per-instance byte
+    budget, backup-root byte budget. Byte budgets count incremental backups as
+    their manifest plus the blobs they reference, each blob once. Returns a
+    list of (path, instance, tier, taken_at, size, reason), oldest first.
+    """
+    rows = catalog.execute(
+        "SELECT path, instance, tier, taken_at, size, sha256 FROM backups ORDER BY taken_at DESC"
+    ).fetchall()
+
+    prune = {}
+    newest = {}
+    tiers = {}
+    for row in rows:
+        path, instance, tier = row[:3]
+        newest.setdefault(instance, row[5])
+        tiers.setdefault((instance, tier), []).append(row)
+
+    # Count and age limits, per tier (newest first)
+    for (instance, tier), backups in tiers.items():
+        config = RETENTION.get(tier)
+        if not config or not config['enabled']:
+            continue
+        max_age = parse_duration(config['max_age'])
+        for position, row in enumerate(backups):
+            taken_at = datetime.strptime(row[3], TIMESTAMP_FORMAT)
+            if position >= config['keep']:
+                prune[row[0]] = (row, "count")
+            elif max_age and now - taken_at > max_age and row[5] != newest[row[1]]:
+                prune[row[0]] = (row, "age")
+
+    manifest_blobs = {}
+    blob_sizes = {}
+
+    def blobs_of(instance, manifest):
+        """Blob keys an incremental manifest references, read once per plan."""
+        if manifest not in manifest_blobs:
+            try:
+                manifest_blobs[manifest] = {
+                    (instance, entry["sha256"])
+                    for entry in load_manifest(manifest)["entries"]
+                    if entry.get("type") == "file"
+                }
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Budget ignores blobs of unreadable manifest {manifest}: {e}")
+                manifest_blobs[manifest] = set()
+        return manifest_blobs[manifest]
+
+    def blob_size(key):
+        if key not in blob_sizes:
+            instance, digest = key
+            try:
+                blob_sizes[key] = os.path.getsize(blob_path(os.path.join(BACKUP_ROOT, instance, BLOB_DIR), digest))
+            except OSError:
+                blob_sizes[key] = 0
+        return blob_sizes[key]
+
+    def enforce_budget(candidates, budget, reason):
+        """Drop whole content groups (hardlinked tier copies share a checksum), oldest first."""
+        groups = {}
+        for row in candidates:
+            if row[0] not in prune:
+                groups.setdefault((row[1], row[5]), []).append(row)
+
+        # A blob is freed once no retained manifest references it; the
+        # manifest the next run diffs against pins its blobs too
+        references = {}
+        for (instance, sha256), group in groups.items():
+            if group[0][0].endswith(MANIFEST_SUFFIX):
+                for key in blobs_of(instance, catalog_path(group[0][0])):
+                    references[key] = references.get(key, 0) + 1
+        for instance in {instance for instance, _ in groups}:
+            last = os.path.join(BACKUP_ROOT, instance, LAST_MANIFEST)
+            if os.path.exists(last):
+                for key in blobs_of(instance, last):
+                    references[key] = references.get(key, 0) + 1
+
+        # Hardlinked copies share their data, so a checksum only costs its size once
+        usage = sum(group[0][4] for group in groups.values()) + sum(blob_size(key) for key in references)
+        for (instance, sha256), group in sorted(groups.items(), key=lambda g: max(r[3] for r in g[1])):
+            if usage <= budget:
+                break
+            if sha256 == newest[instance]:
+                continue
+            for row in group:
+                prune[row[0]] = (row, reason)
+            usage -= group[0][4]
+            if group[0][0].endswith(MANIFEST_SUFFIX):
+                for key in blobs_of(instance, catalog_path(group[0][0])):
+                    references[key] -= 1
+                    if not references[key]:
+                        usage -= blob_size(key)
+
+    if MAX_BYTES_PER_INSTANCE:
+        for instance in newest:
+            enforce_budget([r for r in rows if r[1] == instance], MAX_BYTES_PER_INSTANCE, "instance budget")
+
+    if MAX_BYTES_TOTAL:
+        enforce_budget(rows, MAX_BYTES_TOTAL, "total budget")
+
+    return sorted(
+        ((row[0], row[1], row[2], row[3], row[4], reason) for row, reason in prune.values()),
+        key=lambda item: item[3],
+    )
+
+def apply_retention(catalog, plan, dry_run=False):
+    """Carry out (or just print) a retention plan, then clean up orphaned blobs."""
+    freed = 0
+    touched = set()
+    for path, instance, tier, taken_at, size, reason in plan:
+        if dry_run:
+            logging.info(f"Would prune {catalog_path(path)} ({reason}, {size} bytes)")
+        elif not remove_backup(catalog, path):
+            continue
+        freed += size
+        if path.endswith(MANIFEST_SUFFIX):
+            touched.add(instance)
+
+    verb = "Would prune" if dry_run else "Pruned"
+    logging.info(f"Retention: {verb} {len(plan)} backups, {freed} bytes")
+
+    if not dry_run:
+        for instance in sorted(touched):
+            collect_garbage(catalog, instance, os.path.join(BACKUP_ROOT, instance))
+
+# ==========================================
+# CHANGE DETECTION
+# ==========================================
+
+def instance_fingerprint(src_path, instance_name, suffix):
+    """
+    Cheap digest of everything tar would archive, from one scandir pass.
+    The backup suffix is included so switching codec or mode forces a fresh backup.
+    """
+    digest = hashlib.sha256(suffix.encode())
+    for name, path, st in walk_instance(src_path, instance_name):
+        digest.update(f"{name}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n".encode())
+    return digest.hexdigest()
+
+def unchanged_backup(catalog, instance_name, fingerprint):
+    """(path, size, sha256) of a retained backup taken from this exact state, or None."""
+    rows = catalog.execute(
+        "SELECT b.path, b.size, b.sha256 FROM fingerprints f "
+        "JOIN backups b ON b.instance = f.instance AND b.sha256 = f.sha256 "
+        "WHERE f.instance = ? AND f.fingerprint = ? ORDER BY b.taken_at DESC",
+        (instance_name, fingerprint),
+    )
+    for rel_path, size, sha256 in rows:
+        path = catalog_path(rel_path)
+        if os.path.exists(path):
+            return path, size, sha256
+    return None
+
+def record_fingerprint(catalog, instance_name, fingerprint, sha256):
+    with catalog:
+        catalog.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+            (instance_name, fingerprint, sha256),
+        )
+
+# ==========================================
+# SNAPSHOT CAPTURE
+# ==========================================
+
+def parse_instance_map(value):
+    """Parse "name=value,name2=value2" into a dict."""
+    result = {}
+    for item in value.split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            result[key.strip()] = val.strip()
+    return result
+
+def capture_method(instance_name):
+    return parse_instance_map(CAPTURE).get(instance_name, CAPTURE_DEFAULT).lower()
+
+def run_command(*args):
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {result.stderr.strip()}")
+    return result.stdout
+
+@contextmanager
+def btrfs_snapshot(instance_name, src_path):
+    """Read-only snapshot of the subvolume holding src_path."""
+    subvol = os.path.realpath(src_path)
+    dev = os.stat(subvol).st_dev
+    while os.stat(subvol).st_ino != BTRFS_SUBVOL_INO:
+        parent = os.path.dirname(subvol)
+        if parent == subvol or os.stat(parent).st_dev != dev:
+            raise RuntimeError(f"{src_path} is not on a btrfs subvolume")
+        subvol = parent
+
+    snapshot = os.path.join(subvol, f"{SNAPSHOT_PREFIX}{instance_name}-{os.getpid()}")
+    run_command("btrfs", "subvolume", "snapshot", "-r", subvol, snapshot)
+    try:
+        yield os.path.join(snapshot, os.path.relpath(os.path.realpath(src_path), subvol))
+    finally:
+        run_command("btrfs", "subvolume", "delete", snapshot)
+
+@contextmanager
+def zfs_snapshot(instance_name, src_path):
+    """Snapshot of the dataset holding src_path, read through its .zfs directory."""
+    dataset, mountpoint = run_command("zfs", "list", "-H", "-o", "name,mountpoint", src_path).split("\t")
+    mountpoint = mountpoint.strip()
+
+    name = f"{SNAPSHOT_PREFIX.lstrip('.')}{instance_name}-{os.getpid()}"
+    run_command("zfs", "snapshot", f"{dataset}@{name}")
+    try:
+        rel_path = os.path.relpath(os.path.realpath(src_path), mountpoint)
+        yield os.path.join(mountpoint, ".zfs", "snapshot", name, rel_path)
+    finally:
+        run_command("zfs", "destroy", f"{dataset}@{name}")
+
+class QbtApi:
+    """Minimal qBittorrent WebUI API (v2) client for pausing and resuming torrents."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def call(self, endpoint, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(
+            f"{self.base_url}/api/v2/{endpoint}",
+            data=body,
+            headers={"Referer": self.base_url},
+        )
+        with self.opener.open(request, timeout=30) as response:
+            return response.read().decode()
+
+    def login(self):
+        if not API_USERNAME:
+            return
+        with open(API_PASSWORD_FILE) as f:
+            password = f.read().strip()
+        if self.call("auth/login", {"username": API_USERNAME, "password": password}).strip() != "Ok.":
+            raise RuntimeError(f"qBittorrent API login failed for {self.base_url}")
+
+    def verbs(self):
+        """qBittorrent 5 (WebAPI 2.11) renamed pause/resume to stop/start."""
+        version = tuple(int(p) for p in self.call("app/webapiVersion").strip().split("."))
+        return ("stop", "start") if version >= (2, 11) else ("pause", "resume")
+
+    def active_hashes(self):
+        torrents = json.loads(self.call("torrents/info"))
+        return [t["hash"] for t in torrents if not t["state"].startswith(("paused", "stopped"))]
+
+@contextmanager
+def api_capture(instance_name, src_path):
+    """Pause running torrents, copy the instance aside, resume; archive the copy."""
+    base_url = parse_instance_map(API_URLS).get(instance_name)
+    if not base_url:
+        raise RuntimeError(f"No WebUI URL configured for {instance_name} (QBT_API_URLS)")
+
+    api = QbtApi(base_url)
+    api.login()
+    pause, resume = api.verbs()
+    hashes = "|".join(api.active_hashes())
+
+    staging = os.path.join(os.path.dirname(os.path.normpath(src_path)), f"{SNAPSHOT_PREFIX}{instance_name}-{os.getpid()}")
+    try:
+        started = monotonic()
+        if hashes:
+            api.call(f"torrents/{pause}", {"hashes": hashes})
+        try:
+            sleep(API_SETTLE_SECONDS)
+            copy_tree(src_path, instance_name, staging)
+        finally:
+            # Only torrents we paused are resumed; user-paused ones stay paused
+            if hashes:
+                api.call(f"torrents/{resume}", {"hashes": hashes})
+        logging.info(f"{instance_name} torrents paused for {monotonic() - started:.1f}s while copying")
+
+        yield staging
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def copy_tree(src_path, instance_name, dest):
+    """Copy what tar would archive (same exclusions) to dest."""
+    for name, path, st in walk_instance(src_path, instance_name):
+        target = os.path.join(dest, os.path.relpath(name, instance_name))
+        if stat.S_ISDIR(st.st_mode):
+            os.makedirs(target, exist_ok=True)
+            shutil.copystat(path, target)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(path), target)
+        else:
+            shutil.copy2(path, target)
+
+@contextmanager
+def captured_source(instance_name, src_path):
+    """Yield a path holding a consistent view of the instance."""
+    method = capture_method(instance_name)
+    if method == "none":
+        yield src_path
+        return
+
+    capture = {"btrfs": btrfs_snapshot, "zfs": zfs_snapshot, "api": api_capture}.get(method)
+    if capture is None:
+        raise ValueError(f"Unknown capture method for {instance_name}: {method}")
+
+    logging.info(f"Capturing {instance_name} ({method})...")
+    with capture(instance_name, src_path) as view:
+        yield view
+
+# ==========================================
+# INCREMENTAL (CONTENT-ADDRESSED) MODE
+# ==========================================
+
+def walk_instance(src_path, arcname):
+    """
+    Yield (name, path, lstat) for everything tar would archive, parents first.
+    Applies the same exclusions as tar_filter and never follows symlinks.
+    """
+    stack = [(src_path, arcname)]
+    yield arcname, src_path, os.lstat(src_path)
+
+    while stack:
+        path, name = stack.pop()
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        subdirs = []
+        for entry in entries:
+            entry_name = f"{name}/{entry.name}"
+            if is_excluded(entry_name):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            mode = st.st_mode
+            # Same as tar_filter: skip device nodes, FIFOs and sockets
+            if not (stat.S_ISREG(mode) or stat.S_ISDIR(mode) or stat.S_ISLNK(mode)):
+                continue
+            yield entry_name, entry.path, st
+            if stat.S_ISDIR(mode):
+                subdirs.append((entry.path, entry_name))
+
+        # Reversed so the stack pops them in sorted order
+        stack.extend(reversed(subdirs))
+
+def blob_path(blob_root, digest):
+    return os.path.join(blob_root, digest[:2], f"{digest}.gz")
+
+def store_blob(blob_root, file_path):
+    """
+    Hash a file and store its compressed content under its SHA-256.
+    The file is read exactly once. Returns (digest, bytes_written).
+    """
+    fd, temp_blob = tempfile.mkstemp(prefix=".tmp_", dir=blob_root)
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                with open(file_path, "rb") as src:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                        gz.write(chunk)
+        digest = digest.hexdigest()
+
+        final_blob = blob_path(blob_root, digest)
+        if os.path.exists(final_blob):
+            os.remove(temp_blob)
+            return digest, 0
+
+        os.makedirs(os.path.dirname(final_blob), exist_ok=True)
+        written = os.path.getsize(temp_blob)
+        os.replace(temp_blob, final_blob)
+        return digest, written
+    except BaseException:
+        if os.path.exists(temp_blob):
+            os.remove(temp_blob)
+        raise
+
+def load_manifest(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_manifest(path, manifest):
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL) as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+def build_manifest(instance_name, src_path, dst_base, stable_inodes=True):
+    """
+    Walk the instance and store any new file contents in the blob store.
+    Files whose size, mtime and inode match the previous manifest are not read again.
+    A staging copy gets new inodes on every run, so with stable_inodes=False
+    only size and mtime are compared (copy_tree preserves mtimes).
+    """
+    blob_root = os.path.join(dst_base, BLOB_DIR)
+    os.makedirs(blob_root, exist_ok=True)
+
+    previous = {}
+    last_manifest = os.path.join(dst_base, LAST_MANIFEST)
+    if os.path.exists(last_manifest):
+        try:
+            previous = {e["path"]: e for e in load_manifest(last_manifest)["entries"]}
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable previous manifest {last_manifest}: {e}")
+
+    entries = []
+    stored = reused = bytes_written = 0
+
+    for name, path, st in walk_instance(src_path, instance_name):
+        entry = {
+            "path": name,
+            "mode": stat.S_IMODE(st.st_mode),
+            "uid": st.st_uid,
+            "gid": st.st_gid,
+            "mtime_ns": st.st_mtime_ns,
+        }
+
+        if stat.S_ISDIR(st.st_mode):
+            entry["type"] = "dir"
+        elif stat.S_ISLNK(st.st_mode):
+            entry["type"] = "symlink"
+            entry["target"] = os.readlink(path)
+        else:
+            entry["type"] = "file"
+            entry["size"] = st.st_size
+            if stable_inodes:
+                entry["ino"] = st.st_ino
+
+            prev = previous.get(name)
+            if (prev and prev.get("type") == "file"
+                    and prev.get("size") == st.st_size
+                    and prev.get("mtime_ns") == st.st_mtime_ns
+                    and (not stable_inodes or prev.get("ino") == st.st_ino)):
+                entry["sha256"] = prev["sha256"]
+                reused += 1
+            else:
+                entry["sha256"], written = store_blob(blob_root, path)
+                bytes_written += written
+                stored += 1
+
+        entries.append(entry)
+
+    logging.info(
+        f"Indexed {instance_name}: {len(entries)} entries, {stored} files hashed, "
+        f"{reused} unchanged, {bytes_written} new blob bytes"
+    )
+
+    return {
+        "version": MANIFEST_VERSION,
+        "instance": instance_name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "entries": entries,
+    }
+
+def collect_garbage(catalog, instance_name, dst_base):
+    """Delete blobs no longer referenced by any retained manifest."""
+    blob_root = os.path.join(dst_base, BLOB_DIR)
+    if not os.path.isdir(blob_root):
+        return
+
+    manifests = [os.path.join(dst_base, LAST_MANIFEST)]
+    manifests.extend(
+        catalog_path(rel_path) for (rel_path,) in catalog.execute(
+            "SELECT path FROM backups WHERE instance = ? AND path LIKE ?",
+            (instance_name, f"%{MANIFEST_SUFFIX}"),
+        )
+    )
+
+    referenced = set()
+    for manifest in manifests:
+        if not os.path.exists(manifest):
+            continue
+        try:
+            for entry in load_manifest(manifest)["entries"]:
+                if entry.get("type") == "file":
+                    referenced.add(entry["sha256"])
+        except (OSError, ValueError, KeyError) as e:
+            # Never delete blobs on the basis of a manifest we could not read
+            logging.error(f"Skipping blob cleanup, cannot read {manifest}: {e}")
+            return
+
+    removed = 0
+    for blob in glob(os.path.join(blob_root, "*", "*.gz")):
+        if os.path.basename(blob)[:-len(".gz")] not in referenced:
+            try:
+                os.remove(blob)
+                removed += 1
+            except OSError as e:
+                logging.error(f"Error deleting blob {blob}: {e}")
+
+    if removed:
+        logging.info(f"Removed {removed} unreferenced blobs from {blob_root}")
+
+def _restore_path(target_dir, name):
+    dest = os.path.normpath(os.path.join(target_dir, name))
+    if os.path.commonpath([target_dir, dest]) != target_dir:
+        raise ValueError(f"Refusing to restore outside target: {name}")
+    return dest
+
+def extract_manifest(manifest_path, blob_root, target_dir):
+    """Rebuild the tree described by a manifest from the blob store."""
+    target_dir = os.path.abspath(target_dir)
+    entries = load_manifest(manifest_path)["entries"]
+    as_root = os.geteuid() == 0
+
+    for entry in entries:
+        dest = _restore_path(target_dir, entry["path"])
+        kind = entry["type"]
+
+        if kind == "dir":
+            os.makedirs(dest, exist_ok=True)
+            continue
+
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+        if kind == "symlink":
+            os.symlink(entry["target"], dest)
+        else:
+            with gzip.open(blob_path(blob_root, entry["sha256"]), "rb") as src, open(dest, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        if as_root:
+            os.lchown(dest, entry["uid"], entry["gid"])
+        if kind == "file":
+            os.chmod(dest, entry["mode"])
+            os.utime(dest, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    # Directories last (deepest first) so writing children doesn't bump their mtime
+    for entry in reversed(entries):
+        if entry["type"] != "dir":
+            continue
+        dest = _restore_path(target_dir, entry["path"])
+        if as_root:
+            os.chown(dest, entry["uid"], entry["gid"])
+        os.chmod(dest, entry["mode"])
+        os.utime(dest, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+# ==========================================
+# BACKUP / RESTORE
+# ==========================================
 
 def perform_backup(instance_name):
+    """
+    Back up one instance. Never raises; returns one of
+    "ok", "unchanged" (promoted the previous backup), "not due", "skipped" or "failed".
+    """
     src_path = os.path.join(SOURCE_ROOT, instance_name)
     dst_base = os.path.join(BACKUP_ROOT, instance_name)
     
     if not os.path.exists(src_path):
         logging.warning(f"Source not found: {src_path}")
-        return
+        return "skipped"
+
+    incremental = BACKUP_MODE == "incremental"
+    suffix = MANIFEST_SUFFIX if incremental else CODEC_SUFFIXES[COMPRESSION]
 
     # Use PID to ensure temp file is unique
-    temp_archive = os.path.join(dst_base, f".tmp_{os.getpid()}_{instance_name}.tar.gz")
+    temp_archive = os.path.join(dst_base, f".tmp_{os.getpid()}_{instance_name}{suffix}")
+
+    catalog = None
 
     try:
         os.makedirs(dst_base, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f"{instance_name}_{timestamp}.tar.gz"
-        
-        logging.info(f"Archiving {instance_name} (Level {COMPRESSION_LEVEL})...")
-        
-        # dereference=False ensures we archive symlinks AS links, not the target content
-        with tarfile.open(temp_archive, "w:gz", compresslevel=COMPRESSION_LEVEL, dereference=False) as tar:
-            tar.add(src_path, arcname=os.path.basename(src_path), filter=tar_filter)
-            
+        catalog = open_catalog()
         now = datetime.now()
-        
-        # Distribute to Retention Folders
-        for interval, config in RETENTION.items():
-            if not config['enabled']:
-                continue
+        timestamp = now.strftime(TIMESTAMP_FORMAT)
+        filename = f"{instance_name}_{timestamp}{suffix}"
+
+        due = [
+            interval for interval, config in RETENTION.items()
+            if config['enabled'] and should_run_backup(
+                interval, get_latest_backup_time(catalog, instance_name, interval), now)
+        ]
+        if not due:
+            logging.info(f"No retention tier due for {instance_name}, nothing to do")
+            return "not due"
 
+        # Pausing for "api" capture rewrites the fastresume files, so the
+        # fingerprint would never match; incremental mode still reuses blobs
+        capture = capture_method(instance_name)
+        fingerprint = None
+        if SKIP_UNCHANGED and capture != "api":
+            fingerprint = instance_fingerprint(src_path, instance_name, suffix)
+        previous = unchanged_backup(catalog, instance_name, fingerprint) if fingerprint else None
+
+        if previous:
+            source, size, checksum = previous
+            logging.info(f"{instance_name} unchanged since {os.path.basename(source)}, skipping archive")
+        elif incremental:
+            source = temp_archive
+            with captured_source(instance_name, src_path) as view:
+                logging.info(f"Indexing {instance_name} into blob store (Level {GZIP_LEVEL})...")
+                # The "api" view is a fresh copy with new inodes every run
+                manifest = build_manifest(instance_name, view, dst_base, stable_inodes=capture != "api")
+                write_manifest(temp_archive, manifest)
+            size, checksum = os.path.getsize(temp_archive), file_sha256(temp_archive)
+        else:
+            source = temp_archive
+            with captured_source(instance_name, src_path) as view:
+                logging.info(f"Archiving {instance_name} ({COMPRESSION}, Level {COMPRESSION_LEVEL})...")
+                
+                # Stream mode ("w|") pipes tar blocks straight into the compressor,
+                # and the archive is checksummed on its way to disk.
+                # dereference=False ensures we archive symlinks AS links, not the target content
+                with open(temp_archive, "wb") as raw:
+                    hashed = HashingWriter(raw)
+                    with compressed_writer(hashed, COMPRESSION) as out:
+                        with tarfile.open(fileobj=out, mode="w|", dereference=False) as tar:
+                            tar.add(view, arcname=instance_name, filter=tar_filter)
+            size, checksum = hashed.size, hashed.sha256.hexdigest()
+            
+        # Distribute to Retention Folders
+        for interval in due:
             interval_path = os.path.join(dst_base, interval)
             os.makedirs(interval_path, exist_ok=True)
             
-            last_time = get_latest_backup_time(interval_path)
-            
-            if should_run_backup(interval, last_time, now):
-                final_dest = os.path.join(interval_path, filename)
-                shutil.copy2(temp_archive, final_dest)
-                logging.info(f"Promoted to {interval}: {final_dest}")
-                clean_old_backups(interval_path, config['keep'])
+            final_dest = os.path.join(interval_path, filename)
+            method = promote_file(source, final_dest)
+            record_backup(catalog, final_dest, instance_name, interval, timestamp, size, checksum)
+            logging.info(f"Promoted to {interval} ({method}): {final_dest}")
+
+        if fingerprint and not previous:
+            record_fingerprint(catalog, instance_name, fingerprint, checksum)
+
+        if incremental and not previous:
+            # The newest manifest doubles as the hash cache for the next run
+            os.replace(temp_archive, os.path.join(dst_base, LAST_MANIFEST))
+
+        return "unchanged" if previous else "ok"
 
     except Exception as e:
         logging.error(f"Backup failed for {instance_name}: {str(e)}")
+        return "failed"
         
     finally:
+        if catalog is not None:
+            catalog.close()
         if os.path.exists(temp_archive):
             try:
                 os.remove(temp_archive)
             except OSError:
                 pass
 
-def main():
+def find_backup(catalog, instance_name, at=None):
+    """(path, sha256) of the newest backup of an instance taken at or before `at`."""
+    at = (at or datetime.max).strftime(TIMESTAMP_FORMAT)
+    row = catalog.execute(
+        "SELECT path, sha256 FROM backups WHERE instance = ? AND taken_at <= ? "
+        "ORDER BY taken_at DESC LIMIT 1",
+        (instance_name, at),
+    ).fetchone()
+    return (catalog_path(row[0]), row[1]) if row else (None, None)
+
+def restore_backup(instance_name, target_dir, at=None):
+    if not check_mount():
+        return 1
+
+    with closing(open_catalog()) as catalog:
+        backup, expected = find_backup(catalog, instance_name, at)
+    if backup is None:
+        logging.error(f"No backup of {instance_name} found" + (f" at or before {at}" if at else ""))
+        return 1
+
+    os.makedirs(target_dir, exist_ok=True)
+    logging.info(f"Restoring {backup} into {target_dir}...")
+
+    try:
+        if backup.endswith(MANIFEST_SUFFIX):
+            if file_sha256(backup) != expected:
+                raise RuntimeError(f"checksum mismatch for {backup}")
+            blob_root = os.path.join(BACKUP_ROOT, instance_name, BLOB_DIR)
+            extract_manifest(backup, blob_root, target_dir)
+        elif read_archive(backup, extract_to=target_dir) != expected:
+            # Only known once the single streaming pass is done
+            raise RuntimeError(f"checksum mismatch for {backup}, restored files may be damaged")
+    except Exception as e:
+        logging.error(f"Restore failed for {instance_name}: {str(e)}")
+        return 1
+
+    logging.info("Restore Complete.")
+    return 0
+
+# ==========================================
+# VERIFY
+# ==========================================
+
+def verify_file(path, expected):
+    """
+    Worker: check one archive or manifest against its catalog checksum.
+    Returns (path, error or None, blob digests referenced by a manifest).
+    """
+    try:
+        if path.endswith(MANIFEST_SUFFIX):
+            if file_sha256(path) != expected:
+                return path, "checksum mismatch", set()
+            entries = load_manifest(path)["entries"]
+            return path, None, {e["sha256"] for e in entries if e["type"] == "file"}
+
+        if read_archive(path) != expected:
+            return path, "checksum mismatch", set()
+        return path, None, set()
+    except Exception as e:
+        return path, str(e), set()
+
+def verify_blobs(blob_root, digests):
+    """Worker: decompress blobs and check each against the digest in its name."""
+    errors = []
+    for digest in digests:
+        path = blob_path(blob_root, digest)
+        try:
+            actual = hashlib.sha256()
+            with gzip.open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    actual.update(chunk)
+            if actual.hexdigest() != digest:
+                errors.append((path, "checksum mismatch"))
+        except Exception as e:
+            errors.append((path, str(e)))
+    return errors
+
+def verify_backups(instance_name=None, workers=None):
+    """Verify every cataloged backup (and referenced blob) across a process pool."""
+    if not check_mount():
+        return 1
+
+    query = "SELECT path, instance, sha256 FROM backups"
+    params = ()
+    if instance_name:
+        query += " WHERE instance = ?"
+        params = (instance_name,)
+    with closing(open_catalog()) as catalog:
+        rows = catalog.execute(query, params).fetchall()
+
+    started = monotonic()
+    failures = []
+
+    # Hardlinked tiers share their data, so each distinct file is read once
+    files = {}
+    for rel_path, instance, sha256 in rows:
+        path = catalog_path(rel_path)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            failures.append((path, str(e)))
+            continue
+        files.setdefault((st.st_dev, st.st_ino), (path, instance, sha256, st.st_size))
+
+    logging.info(f"Verifying {len(files)} backup files ({len(rows)} catalog entries)...")
+
+    blobs = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(verify_file, path, sha256): instance for path, instance, sha256, _ in files.values()}
+        for future in as_completed(futures):
+            path, error, digests = future.result()
+            if error:
+                failures.append((path, error))
+            blobs.setdefault(futures[future], set()).update(digests)
+
+        # Blobs are shared between manifests; check each one once, in batches
+        futures = []
+        for instance, digests in blobs.items():
+            blob_root = os.path.join(BACKUP_ROOT, instance, BLOB_DIR)
+            digests = sorted(digests)
+            for i in range(0, len(digests), 256):
+                futures.append(pool.submit(verify_blobs, blob_root, digests[i:i + 256]))
+        for future in as_completed(futures):
+            failures.extend(future.result())
+
+    for path, error in sorted(failures):
+        logging.error(f"Verify failed: {path}: {error}")
+
+    total_bytes = sum(size for *_, size in files.values())
+    blob_count = sum(len(d) for d in blobs.values())
+    logging.info(
+        f"Verified {len(files)} files ({total_bytes} bytes) and {blob_count} blobs "
+        f"in {monotonic() - started:.1f}s: {len(failures)} failed"
+    )
+    return 1 if failures else 0
+
+def check_mount():
     if not is_mount_safe():
         msg = f"CRITICAL: Mount point {MOUNT_POINT_TO_CHECK} is not mounted! Aborting to protect root FS."
         logging.critical(msg)
+        return False
+    return True
+
+def reindex():
+    if not check_mount():
+        return 1
+    with closing(open_catalog()) as catalog:
+        reindex_catalog(catalog)
+    return 0
+
+def prune(dry_run=False):
+    if not check_mount():
+        return 1
+    with closing(open_catalog()) as catalog:
+        apply_retention(catalog, plan_retention(catalog, datetime.now()), dry_run)
+    return 0
+
+def run_backups():
+    if not check_mount():
         return
 
     if not os.path.exists(SOURCE_ROOT):
         logging.error(f"Source directory {SOURCE_ROOT} does not exist.")
         return
 
+    # Create (and on first use, populate) the catalog before workers share it
+    open_catalog().close()
+
     instances = [d for d in os.listdir(SOURCE_ROOT) if os.path.isdir(os.path.join(SOURCE_ROOT, d))]
+    instances = [i for i in instances if i != 'lost+found' and not i.startswith(SNAPSHOT_PREFIX)]
     
-    logging.info("Starting Backup Run...")
+    logging.info(f"Starting Backup Run ({len(instances)} instances, {WORKERS} workers)...")
     
-    for instance in instances:
-        if instance == 'lost+found': 
-            continue
-            
-        logging.info(f"Processing instance: {instance}")
-        perform_backup(instance)
+    results = {}
+    if WORKERS == 1:
+        for instance in instances:
+            results[instance] = timed_backup(instance)[1:]
+    else:
+        with ProcessPoolExecutor(max_workers=min(WORKERS, len(instances) or 1)) as pool:
+            futures = {pool.submit(timed_backup, instance): instance for instance in instances}
+            for future in as_completed(futures):
+                instance = futures[future]
+                try:
+                    results[instance] = future.result()[1:]
+                except Exception as e:
+                    # A worker that died (OOM kill, BrokenProcessPool) only fails its own instance
+                    logging.error(f"Backup failed for {instance}: worker error: {str(e)}")
+                    results[instance] = ("failed", 0.0)
+
+    logging.info("Backup Summary:")
+    for instance in sorted(results, key=lambda i: results[i][1], reverse=True):
+        status, elapsed = results[instance]
+        logging.info(f"  {instance}: {status} in {elapsed:.2f}s")
+
+    # Retention runs once, after every instance, so the root budget sees the whole picture
+    try:
+        with closing(open_catalog()) as catalog:
+            apply_retention(catalog, plan_retention(catalog, datetime.now()))
+    except Exception as e:
+        logging.error(f"Retention failed: {str(e)}")
     
     logging.info("Backup Run Complete.")
 
+def timed_backup(instance):
+    """Worker entry point: back up one instance and report (name, status, seconds)."""
+    logging.info(f"Processing instance: {instance}")
+    started = monotonic()
+    status = perform_backup(instance)
+    return instance, status, monotonic() - started
+
+def positive_int(value):
+    """argparse type: an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return number
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiered backups of qBittorrent instances.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("run", help="Back up all instances (default).")
+
+    restore = subparsers.add_parser("restore", help="Restore one instance from a point in time.")
+    restore.add_argument("instance", help="Instance name (directory under the source root).")
+    restore.add_argument("target", help="Directory to restore into.")
+    restore.add_argument(
+        "--at",
+        type=lambda value: datetime.strptime(value, TIMESTAMP_FORMAT),
+        help="Restore the newest backup taken at or before this time (YYYY-MM-DD_HH-MM-SS). Defaults to the latest.",
+    )
+
+    subparsers.add_parser("reindex", help="Rebuild the backup catalog from the files on disk.")
+
+    prune_parser = subparsers.add_parser("prune", help="Apply retention limits without backing anything up.")
+    prune_parser.add_argument("--dry-run", action="store_true", help="Only print what would be pruned.")
+
+    verify = subparsers.add_parser("verify", help="Check every cataloged backup reads back intact.")
+    verify.add_argument("--instance", help="Only verify this instance.")
+    verify.add_argument("--workers", type=positive_int, default=os.cpu_count(), help="Parallel verify processes (default: CPU count).")
+
+    args = parser.parse_args()
+
+    if args.command == "prune":
+        return prune(args.dry_run)
+
+    if args.command == "verify":
+        return verify_backups(args.instance, args.workers)
+
+    if args.command == "reindex":
+        return reindex()
+
+    if args.command == "restore":
+        return restore_backup(args.instance, args.target, args.at)
+
+    run_backups()
+    return 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
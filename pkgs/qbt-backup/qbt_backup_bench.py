@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for qbt_backup.py.
+
+Generates synthetic qBittorrent instances in a temp dir, runs the real
+backup script once per (mode, codec, level) in a child process and records
+wall time, CPU time, peak RSS and bytes written. Also times the hot helpers
+(tar_filter, fingerprinting, catalog retention queries) in-process.
+Results are printed (or written) as JSON so runs can be compared between releases.
+
+    python3 qbt_backup_bench.py --torrents 20000 --output bench.json
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter, sleep
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qbt_backup.py")
+
+# Representative levels; --all-levels sweeps each codec's full range
+LEVELS = {
+    'gzip': [1, 6, 9],
+    'zstd': [1, 3, 9, 19],
+    'lz4':  [0, 9, 16],
+    'none': [0],
+}
+ALL_LEVELS = {
+    'gzip': list(range(1, 10)),
+    'zstd': list(range(1, 20)),
+    'lz4':  list(range(0, 17)),
+    'none': [0],
+}
+CODEC_MODULES = {'zstd': "zstandard", 'lz4': "lz4"}
+
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+# ==========================================
+# SYNTHETIC INSTANCES
+# ==========================================
+
+def generate_instance(root, name, args, rng):
+    """Build a tree shaped like a qBittorrent profile. Returns (files, bytes)."""
+    base = os.path.join(root, name, "qBittorrent")
+    bt_backup = os.path.join(base, "data", "BT_backup")
+    os.makedirs(bt_backup)
+    files = total = 0
+
+    def write(path, size):
+        nonlocal files, total
+        # Half random, half repetitive: roughly the compressibility of bencoded state
+        data = rng.randbytes(size // 2) + bytes(size - size // 2)
+        with open(path, "wb") as f:
+            f.write(data)
+        files += 1
+        total += size
+
+    for i in range(args.torrents):
+        info_hash = f"{rng.getrandbits(160):040x}"
+        write(os.path.join(bt_backup, f"{info_hash}.torrent"), args.torrent_size)
+        write(os.path.join(bt_backup, f"{info_hash}.fastresume"), args.fastresume_size)
+
+    config = os.path.join(base, "config")
+    os.makedirs(config)
+    write(os.path.join(config, "qBittorrent.conf"), 4096)
+    write(os.path.join(config, "categories.json"), 512)
+    open(os.path.join(config, "qBittorrent.lock"), "w").close()
+
+    # Noise that tar_filter is expected to drop
+    for folder in ("cache", "logs"):
+        noise = os.path.join(base, "data", folder)
+        os.makedirs(noise)
+        for i in range(args.noise):
+            write(os.path.join(noise, f"{folder}-{i}.dat"), 8192)
+
+    for i in range(args.symlinks):
+        os.symlink("../config/qBittorrent.conf", os.path.join(base, "data", f"link-{i}"))
+
+    return files, total
+
+def churn(root, fraction, rng):
+    """Rewrite a fraction of the fastresume files, like an hour of seeding would."""
+    resumes = []
+    for dirpath, _, names in os.walk(root):
+        resumes.extend(os.path.join(dirpath, n) for n in names if n.endswith(".fastresume"))
+    changed = rng.sample(resumes, int(len(resumes) * fraction))
+    for path in changed:
+        size = os.path.getsize(path)
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(size // 2) + bytes(size - size // 2))
+    return len(changed)
+
+# ==========================================
+# MEASUREMENT
+# ==========================================
+
+def disk_bytes(root):
+    """Apparent size of everything under root, counting hardlinked files once."""
+    seen = set()
+    total = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            st = os.lstat(os.path.join(dirpath, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+def age_catalog(backup_root, hours=1):
+    """Shift every cataloged backup into the past so the next run finds the hourly tier due."""
+    catalog = sqlite3.connect(os.path.join(backup_root, "catalog.sqlite3"))
+    with catalog:
+        rows = catalog.execute("SELECT path, taken_at FROM backups").fetchall()
+        for path, taken_at in rows:
+            shifted = datetime.strptime(taken_at, TIMESTAMP_FORMAT) - timedelta(hours=hours)
+            catalog.execute(
+                "UPDATE backups SET taken_at = ? WHERE path = ?",
+                (shifted.strftime(TIMESTAMP_FORMAT), path),
+            )
+    catalog.close()
+
+def run_backup(env, backup_root):
+    """Run one backup in a child process; wait4() gives that child's own rusage."""
+    before = disk_bytes(backup_root)
+    started = monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, SCRIPT, "run"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = proc.stderr.read().decode(errors="replace")
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = monotonic() - started
+
+    return {
+        "wall_s": round(wall, 4),
+        "cpu_user_s": round(usage.ru_utime, 4),
+        "cpu_sys_s": round(usage.ru_stime, 4),
+        "peak_rss_kb": usage.ru_maxrss,
+        # Net growth of the backup root (new archives/blobs minus pruned ones)
+        "bytes_written": disk_bytes(backup_root) - before,
+        # Storage writes charged to the child by the kernel (0 on tmpfs)
+        "io_write_bytes": usage.ru_oublock * 512,
+        "exit_status": proc.returncode,
+        "errors": [line for line in stderr.splitlines() if " - ERROR - " in line or " - CRITICAL - " in line],
+    }
+
+def bench_case(source_root, work, mode, codec, level, args):
+    backup_root = os.path.join(work, f"backup-{mode}-{codec}-{level}")
+    os.makedirs(backup_root)
+    env = dict(
+        os.environ,
+        QBT_SOURCE_ROOT=source_root,
+        QBT_BACKUP_ROOT=backup_root,
+        QBT_MOUNT_POINT="/",
+        QBT_BACKUP_MODE=mode,
+        QBT_COMPRESSION=codec,
+        QBT_COMPRESSION_LEVEL=str(level),
+        QBT_WORKERS=str(args.workers),
+        QBT_ENABLE_DAILY="false",
+        QBT_ENABLE_WEEKLY="false",
+        QBT_ENABLE_MONTHLY="false",
+    )
+
+    rng = random.Random(args.seed)
+    results = []
+    # cold: empty backup root; churn: some fastresume files rewritten; idle: nothing changed
+    for phase in ("cold", "churn", "idle"):
+        if phase != "cold":
+            age_catalog(backup_root)
+            # Backup filenames have one-second resolution
+            sleep(1)
+        changed = churn(source_root, args.churn, rng) if phase == "churn" else 0
+        result = run_backup(env, backup_root)
+        result.update({"mode": mode, "compression": codec, "level": level, "phase": phase, "files_changed": changed})
+        results.append(result)
+
+    shutil.rmtree(backup_root)
+    return results
+
+def bench_helpers(source_root, work, args):
+    """Time the per-file and per-tier helpers in-process."""
+    os.environ.update(QBT_SOURCE_ROOT=source_root, QBT_BACKUP_ROOT=os.path.join(work, "helpers"))
+    spec = importlib.util.spec_from_file_location("qbt_backup", SCRIPT)
+    qbt = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(qbt)
+    qbt.logging.disable(qbt.logging.CRITICAL)
+
+    instance = sorted(os.listdir(source_root))[0]
+    src_path = os.path.join(source_root, instance)
+    tarinfos = []
+    for dirpath, dirnames, names in os.walk(src_path):
+        for name in dirnames + names:
+            rel = os.path.relpath(os.path.join(dirpath, name), source_root)
+            tarinfos.append(qbt.tarfile.TarInfo(rel))
+
+    started = perf_counter()
+    kept = sum(qbt.tar_filter(t) is not None for t in tarinfos)
+    tar_filter_s = perf_counter() - started
+
+    started = perf_counter()
+    qbt.instance_fingerprint(src_path, instance, ".tar.gz")
+    fingerprint_s = perf_counter() - started
+
+    # Catalog with args.catalog_entries backups spread over the tiers
+    catalog = qbt.open_catalog()
+    now = datetime.now()
+    tiers = list(qbt.RETENTION)
+    with catalog:
+        catalog.executemany(
+            "INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (f"{instance}/{tiers[i % len(tiers)]}/{i}.tar.gz", instance, tiers[i % len(tiers)],
+                 (now - timedelta(hours=i)).strftime(TIMESTAMP_FORMAT), 1, "0" * 64)
+                for i in range(args.catalog_entries)
+            ],
+        )
+
+    started = perf_counter()
+    for tier in tiers:
+        qbt.get_latest_backup_time(catalog, instance, tier)
+    latest_s = perf_counter() - started
+
+    # Planning only; nothing is deleted
+    started = perf_counter()
+    plan = qbt.plan_retention(catalog, now)
+    plan_s = perf_counter() - started
+    catalog.close()
+
+    return {
+        "tar_filter": {"entries": len(tarinfos), "kept": kept, "seconds": round(tar_filter_s, 6)},
+        "fingerprint": {"instance": instance, "seconds": round(fingerprint_s, 6)},
+        "get_latest_backup_time": {"catalog_entries": args.catalog_entries, "tiers": len(tiers), "seconds": round(latest_s, 6)},
+        "plan_retention": {"catalog_entries": args.catalog_entries, "planned": len(plan), "seconds": round(plan_s, 6)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark qbt_backup.py against synthetic instances.")
+    parser.add_argument("--instances", type=int, default=2)
+    parser.add_argument("--torrents", type=int, default=2000, help="Torrents per instance (one .torrent + one .fastresume each).")
+    parser.add_argument("--torrent-size", type=int, default=16384)
+    parser.add_argument("--fastresume-size", type=int, default=2048)
+    parser.add_argument("--noise", type=int, default=100, help="cache/ and logs/ files per instance (excluded from backups).")
+    parser.add_argument("--symlinks", type=int, default=10)
+    parser.add_argument("--churn", type=float, default=0.05, help="Fraction of fastresume files rewritten before the 'churn' phase.")
+    parser.add_argument("--modes", default="archive,incremental")
+    parser.add_argument("--codecs", default="gzip,zstd,lz4,none")
+    parser.add_argument("--all-levels", action="store_true", help="Sweep every level of each codec.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--catalog-entries", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="Where to build the synthetic data (default: a temp dir).")
+    parser.add_argument("--output", help="Write JSON here instead of stdout.")
+    args = parser.parse_args()
+
+    levels = ALL_LEVELS if args.all_levels else LEVELS
+    codecs = []
+    skipped = []
+    for codec in args.codecs.split(","):
+        module = CODEC_MODULES.get(codec)
+        if module and importlib.util.find_spec(module) is None:
+            skipped.append({"compression": codec, "reason": f"Python module '{module}' not installed"})
+        else:
+            codecs.append(codec)
+
+    work = tempfile.mkdtemp(prefix="qbt-bench-", dir=args.workdir)
+    try:
+        source_root = os.path.join(work, "source")
+        rng = random.Random(args.seed)
+        files = total = 0
+        for i in range(args.instances):
+            f, b = generate_instance(source_root, f"instance{i}", args, rng)
+            files += f
+            total += b
+        pristine = os.path.join(work, "pristine")
+        shutil.copytree(source_root, pristine, symlinks=True)
+
+        results = []
+        for mode in args.modes.split(","):
+            # Incremental blobs are always gzip; only the level matters there
+            for codec in (codecs if mode == "archive" else ["gzip"]):
+                for level in levels[codec]:
+                    print(f"bench: {mode} {codec} level {level}", file=sys.stderr)
+                    # Every case starts from the same data
+                    shutil.rmtree(source_root)
+                    shutil.copytree(pristine, source_root, symlinks=True)
+                    results.extend(bench_case(source_root, work, mode, codec, level, args))
+
+        report = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "host": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "dataset": {
+                "instances": args.instances,
+                "torrents_per_instance": args.torrents,
+                "files": files,
+                "bytes": total,
+                "noise_files_per_instance": args.noise * 2,
+                "symlinks_per_instance": args.symlinks,
+                "churn": args.churn,
+            },
+            "workers": args.workers,
+            "skipped": skipped,
+            "results": results,
+            "helpers": bench_helpers(source_root, work, args),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
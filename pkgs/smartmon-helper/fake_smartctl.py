@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Stand-in for smartctl that replays recorded output from a fixture directory.
+
+Point smartmon-helper at it with ``--smartctl fake_smartctl.py`` and set
+``SMARTMON_FAKE_FIXTURES`` to a directory laid out as::
+
+    scan-open.txt               output of `smartctl --scan-open`
+    devices/<name>.json         output of `smartctl --json --all` for a device
+    devices/<name>.quick.json   optional output of `--json --health --attributes`
+    faults.json                 optional latency and failure injection
+
+``<name>`` is the device path, followed by ``_<type>`` for disks addressed
+through a RAID controller, with every run of non-alphanumerics replaced by
+``_`` (``/dev/bus/0 -d megaraid,3`` becomes ``dev_bus_0_megaraid_3``).
+
+faults.json (all keys optional)::
+
+    {
+      "latency": 0.05,              seconds per query
+      "jitter": 0.02,               uniform extra latency
+      "serialise_controllers": true, one query at a time per RAID controller path
+      "fail": "timeout",            timeout | invalid-json | exit | standby
+      "fail_rate": 0.01,            probability of "fail" per query
+      "exit_status": 4,             used by the "exit" failure
+      "devices": {"<name>": {...}}  per-device overrides of the keys above
+    }
+
+Record fixtures from a real host with ``fake_smartctl.py --record DIR``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fcntl
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+
+FIXTURES_ENV = "SMARTMON_FAKE_FIXTURES"
+STANDBY_EXIT = 2
+
+
+def fixture_name(path: str, device_type: str | None) -> str:
+    key = f"{path}:{device_type}" if device_type and "," in device_type else path
+    return re.sub(r"[^A-Za-z0-9]+", "_", key).strip("_")
+
+
+def _option(arguments: list[str], name: str) -> str | None:
+    for index, argument in enumerate(arguments[:-1]):
+        if argument == name:
+            return arguments[index + 1]
+        if argument.startswith(f"{name}="):
+            return argument.split("=", 1)[1]
+    return None
+
+
+def _faults(fixtures: Path, name: str) -> dict[str, Any]:
+    try:
+        config = json.loads((fixtures / "faults.json").read_text())
+    except FileNotFoundError:
+        return {}
+    overrides = (config.get("devices") or {}).get(name) or {}
+    return {**{key: value for key, value in config.items() if key != "devices"}, **overrides}
+
+
+def replay(fixtures: Path, arguments: list[str]) -> int:
+    if "--scan-open" in arguments or "--scan" in arguments:
+        sys.stdout.write((fixtures / "scan-open.txt").read_text())
+        return 0
+
+    path = arguments[-1]
+    device_type = _option(arguments, "--device") or _option(arguments, "-d")
+    name = fixture_name(path, device_type)
+    faults = _faults(fixtures, name)
+    quick = "--all" not in arguments
+    source = fixtures / "devices" / f"{name}{'.quick' if quick else ''}.json"
+    if quick and not source.exists():
+        source = fixtures / "devices" / f"{name}.json"
+    if not source.exists():
+        print(f"{path}: Unable to detect device type", file=sys.stderr)
+        return 2
+
+    lock = None
+    if faults.get("serialise_controllers") and device_type and "," in device_type:
+        # Controllers that serialise requests: one query per controller path at a time
+        lock = open(fixtures / f".lock-{fixture_name(path, None)}", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        time.sleep(float(faults.get("latency", 0.0)) + random.uniform(0.0, float(faults.get("jitter", 0.0))))
+        failure = faults.get("fail")
+        if failure and random.random() >= float(faults.get("fail_rate", 1.0)):
+            failure = None
+        if failure == "standby" and not any(argument.startswith("--nocheck") or argument == "-n" for argument in arguments):
+            failure = None
+
+        if failure == "timeout":
+            sys.stdout.write(source.read_text()[:64])
+            sys.stdout.flush()
+            print("fake smartctl: simulated hang", file=sys.stderr, flush=True)
+            time.sleep(3600)
+        if failure == "invalid-json":
+            sys.stdout.write(source.read_text()[:-16])
+            return 0
+        if failure == "standby":
+            json.dump(
+                {
+                    "smartctl": {
+                        "exit_status": STANDBY_EXIT,
+                        "messages": [{"string": "Device is in STANDBY mode, exit(2)", "severity": "information"}],
+                    },
+                    "device": {"name": path, "type": device_type},
+                },
+                sys.stdout,
+            )
+            return STANDBY_EXIT
+        sys.stdout.write(source.read_text())
+        if failure == "exit":
+            print("fake smartctl: simulated failure", file=sys.stderr)
+            return int(faults.get("exit_status", 4))
+        return 0
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def record(directory: Path, smartctl: str) -> int:
+    """Capture scan and per-device --all output from real disks."""
+    devices = directory / "devices"
+    devices.mkdir(parents=True, exist_ok=True)
+    scan = subprocess.run([smartctl, "--scan-open"], capture_output=True, text=True, check=False)
+    (directory / "scan-open.txt").write_text(scan.stdout)
+    for line in scan.stdout.splitlines():
+        fields = line.split("#", 1)[0].split()
+        if not fields or not fields[0].startswith("/dev/"):
+            continue
+        device_type = _option(fields + [""], "-d")
+        for suffix, query in (("", ["--all"]), (".quick", ["--health", "--attributes"])):
+            command = [smartctl, "--json", *query]
+            if device_type:
+                command.extend(["--device", device_type])
+            result = subprocess.run([*command, fields[0]], capture_output=True, text=True, check=False)
+            (devices / f"{fixture_name(fields[0], device_type)}{suffix}.json").write_text(result.stdout)
+        print(f"recorded {fields[0]} ({device_type or 'auto'})", file=sys.stderr)
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--record"]:
+        parser = argparse.ArgumentParser(prog="fake_smartctl.py --record")
+        parser.add_argument("directory", type=Path)
+        parser.add_argument("--smartctl", default="smartctl")
+        args = parser.parse_args(argv[1:])
+        return record(args.directory, args.smartctl)
+
+    fixtures = os.environ.get(FIXTURES_ENV)
+    if not fixtures:
+        print(f"fake smartctl: {FIXTURES_ENV} is not set", file=sys.stderr)
+        return 1
+    return replay(Path(fixtures), argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,66 @@
 #!/usr/bin/env python3
-"""One-shot read-only SMART snapshot writer."""
+"""Read-only SMART snapshot writer, as a one-shot run or a polling daemon."""
 
 from __future__ import annotations
 
 import argparse
+import asyncio
+import codecs
+import cProfile
+import gzip
+import hashlib
 import json
 import os
+import pstats
+import re
+import resource
+import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import Any
 
 
 SCHEMA = "smartmon-helper/v1"
+# Summaries only; raw smartctl JSON lives in per-device sidecar files
+SLIM_SCHEMA = "smartmon-helper/v2"
+
+# Light poll between full queries: health verdict plus attributes / NVMe health log
+QUICK_ARGUMENTS = ["--health", "--attributes"]
+FULL_ARGUMENTS = ["--all"]
+
+# Wait for a burst of udev events to settle before rescanning
+RESCAN_DEBOUNCE = 5.0
+
+# smartctl -n standby: skip the query instead of spinning the disk up
+STANDBY_ARGUMENTS = ["--nocheck=standby"]
+STANDBY_MODES = ("STANDBY", "SLEEP")
+
+QUERY_STATUSES = ("ok", "warning", "failed", "unknown", "standby", "error")
+
+SYSFS_BLOCK = Path("/sys/block")
+
+# Per-controller concurrency bounds; NVMe namespaces are independent and
+# are allowed to run all at once.
+GROUP_INITIAL_LIMIT = 2
+GROUP_MAX_LIMIT = 8
+# A query slower than this multiple of the group's best latency times the
+# concurrency it ran at means the controller is serialising requests.
+SERIALISED_RATIO = 0.8
+# Below this multiple of the best latency, extra parallelism is free.
+PARALLEL_RATIO = 1.5
+# Ceiling on concurrent smartctl processes across all groups
+MAX_PROCESSES = 64
+# How much of a timed-out query's output to keep for diagnosis
+PARTIAL_OUTPUT_LIMIT = 4096
+READ_CHUNK = 65536
 
 
 def utc_now() -> str:
@@ -33,18 +77,51 @@ def parse_scan(output: str) -> list[dict[str, str | None]]:
             continue
         fields = line.split()
         path = fields[0]
-        if not path.startswith("/dev/") or path in seen:
+        if not path.startswith("/dev/"):
             continue
         device_type: str | None = None
         for index, field in enumerate(fields[:-1]):
             if field in {"-d", "--device"}:
                 device_type = fields[index + 1]
                 break
-        devices.append({"path": path, "scan_type": device_type})
-        seen.add(path)
+        device: dict[str, str | None] = {"path": path, "scan_type": device_type}
+        # Disks behind a RAID controller share its path (megaraid,N on /dev/bus/0)
+        key = device_key(device)
+        if key in seen:
+            continue
+        devices.append(device)
+        seen.add(key)
     return devices
 
 
+def device_key(device: dict[str, Any]) -> str:
+    """Identify a device; controller-addressed disks need their type to be unique."""
+    path = str(device["path"])
+    scan_type = device.get("scan_type")
+    if scan_type and "," in scan_type:
+        return f"{path}:{scan_type}"
+    return path
+
+
+def controller_key(device: dict[str, str | None]) -> str:
+    """Group devices that share a controller and therefore serialise queries."""
+    path = str(device["path"])
+    scan_type = device.get("scan_type") or ""
+    if _is_nvme(device):
+        return "nvme"
+    if "," in scan_type:
+        return f"{scan_type.split(',', 1)[0]}:{path}"
+    try:
+        parts = (SYSFS_BLOCK / Path(path).name / "device").resolve(strict=True).parts
+    except OSError:
+        parts = ()
+    for part in parts:
+        # AHCI gives every port its own hostN; a SAS HBA puts all disks on one
+        if part.startswith("host") and part[4:].isdigit():
+            return f"scsi:{part}"
+    return f"{scan_type or 'auto'}:{path}"
+
+
 def _nested(mapping: Any, *keys: str) -> Any:
     for key in keys:
         if not isinstance(mapping, dict):
@@ -53,6 +130,14 @@ def _nested(mapping: Any, *keys: str) -> Any:
     return mapping
 
 
+def _ata_attribute(raw: dict[str, Any], attribute_id: int) -> int | None:
+    for attribute in _nested(raw, "ata_smart_attributes", "table") or []:
+        if isinstance(attribute, dict) and attribute.get("id") == attribute_id:
+            value = _nested(attribute, "raw", "value")
+            return value if isinstance(value, int) else None
+    return None
+
+
 def summarize(raw: dict[str, Any]) -> dict[str, Any]:
     """Extract stable fields while retaining full smartctl JSON in each item."""
     nvme_health = raw.get("nvme_smart_health_information_log") or {}
@@ -75,13 +160,92 @@ def summarize(raw: dict[str, Any]) -> dict[str, Any]:
         "temperature_c": temperature,
         "percentage_used": nvme_health.get("percentage_used"),
         "media_errors": nvme_health.get("media_errors"),
+        "available_spare": nvme_health.get("available_spare"),
         "error_log_entries": error_count,
+        "reallocated_sectors": _ata_attribute(raw, 5),
+        "pending_sectors": _ata_attribute(raw, 197),
+        "offline_uncorrectable": _ata_attribute(raw, 198),
+        "udma_crc_errors": _ata_attribute(raw, 199),
+        "power_on_hours": _nested(raw, "power_on_time", "hours") or nvme_health.get("power_on_hours"),
     }
 
 
+def _is_nvme(device: dict[str, str | None]) -> bool:
+    return device.get("scan_type") == "nvme" or str(device["path"]).startswith("/dev/nvme")
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit for one controller group, driven by query latency.
+
+    The limit grows by one while queries stay close to the best latency seen
+    and halves when latency rises in step with concurrency, which is what a
+    controller that serialises requests looks like.
+    """
+
+    def __init__(self, limit: int, maximum: int, best: float | None = None) -> None:
+        self.maximum = max(1, maximum)
+        self.limit = min(max(1, limit), self.maximum)
+        self.best = best
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> int:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+            return self.active
+
+    async def release(self, concurrency: int, latency: float) -> None:
+        async with self.condition:
+            self.active -= 1
+            if self.best is None or latency < self.best:
+                self.best = latency
+            ratio = latency / max(self.best, 1e-6)
+            if concurrency > 1 and ratio >= SERIALISED_RATIO * concurrency:
+                self.limit = max(1, self.limit // 2)
+            elif ratio < PARALLEL_RATIO and concurrency >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+            self.condition.notify_all()
+
+
+class SmartctlTimeout(RuntimeError):
+    """smartctl overran its deadline; carries whatever output it produced."""
+
+    def __init__(self, timeout: float, stdout: str, stderr: str) -> None:
+        super().__init__(f"smartctl timed out after {timeout:g}s")
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+async def _drain(stream: asyncio.StreamReader | None, sink: list[str]) -> None:
+    """Decode a pipe incrementally so partial output survives a kill."""
+    if stream is None:
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while chunk := await stream.read(READ_CHUNK):
+        sink.append(decoder.decode(chunk))
+    sink.append(decoder.decode(b"", final=True))
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _in_standby(raw: dict[str, Any] | None) -> bool:
+    """Whether smartctl -n standby reported the device asleep and skipped it."""
+    messages = _nested(raw, "smartctl", "messages") or []
+    return any(
+        isinstance(message, dict)
+        and any(f"is in {mode} mode" in str(message.get("string", "")) for mode in STANDBY_MODES)
+        for message in messages
+    )
+
+
 def _query_status(raw: dict[str, Any] | None, returncode: int) -> str:
     if raw is None:
         return "error"
+    if _in_standby(raw):
+        return "standby"
     passed = _nested(raw, "smart_status", "passed")
     if passed is False:
         return "failed"
@@ -95,27 +259,107 @@ def _query_status(raw: dict[str, Any] | None, returncode: int) -> str:
 class SmartCollector:
     """Enumerate devices and collect read-only JSON SMART data."""
 
-    def __init__(self, smartctl: str = "smartctl", timeout: float = 45.0) -> None:
+    def __init__(
+        self,
+        smartctl: str = "smartctl",
+        timeout: float = 45.0,
+        skip_standby: bool = False,
+        timings: bool = False,
+    ) -> None:
         self.smartctl = smartctl
         self.timeout = timeout
+        self.skip_standby = skip_standby
+        # Self-instrumentation, reported in the snapshot's "timings" section
+        self.timings = timings
+        self.scan_seconds: float | None = None
+        self.collect_seconds: float | None = None
+        self.device_timings: dict[str, dict[str, float]] = {}
+        # Last awake result per device, served while the device is in standby
+        self.cache: dict[str, dict[str, Any]] = {}
+        # Learned per-controller concurrency, carried between collections
+        self.groups: dict[str, dict[str, Any]] = {}
+        self.processes = asyncio.Semaphore(MAX_PROCESSES)
 
-    def _run(self, arguments: list[str]) -> subprocess.CompletedProcess[str]:
+    def load_state(self, payload: dict[str, Any]) -> None:
+        """Seed the standby cache and learned concurrency from a previous snapshot."""
+        self.load_cache(payload)
+        groups = _nested(payload, "collector", "groups")
+        if isinstance(groups, dict):
+            for key, state in groups.items():
+                if isinstance(state, dict) and isinstance(state.get("limit"), int):
+                    self.groups[key] = {"limit": state["limit"], "best_latency_s": state.get("best_latency_s")}
+
+    def load_cache(self, payload: dict[str, Any]) -> None:
+        """Seed the standby cache from a previously written snapshot."""
+        for item in payload.get("devices") or []:
+            if not isinstance(item, dict) or not item.get("summary"):
+                continue
+            if item.get("query_status") in ("standby", "error"):
+                collected_at = item.get("cached_at")
+            else:
+                collected_at = payload.get("collected_at")
+            if collected_at:
+                self.cache[device_key(item)] = {
+                    "summary": item["summary"],
+                    "smartctl": item.get("smartctl"),
+                    "collected_at": collected_at,
+                }
+
+    def _from_cache(self, item: dict[str, Any]) -> None:
+        cached = self.cache.get(device_key(item))
+        if cached is None:
+            return
+        item["summary"] = cached["summary"]
+        item["smartctl"] = cached["smartctl"]
+        item["cached_at"] = cached["collected_at"]
+        try:
+            age = datetime.now(timezone.utc) - _parse_time(cached["collected_at"])
+            item["cache_age_seconds"] = max(0, int(age.total_seconds()))
+        except ValueError:
+            item["cache_age_seconds"] = None
+
+    async def _run(self, arguments: list[str]) -> subprocess.CompletedProcess[str]:
+        command = [self.smartctl, *arguments]
         try:
-            return subprocess.run(
-                [self.smartctl, *arguments],
-                capture_output=True,
-                text=True,
-                timeout=self.timeout,
-                check=False,
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
             )
         except FileNotFoundError as exc:
             raise RuntimeError(f"smartctl not found: {self.smartctl}") from exc
-        except subprocess.TimeoutExpired as exc:
-            raise RuntimeError(f"smartctl timed out after {self.timeout:g}s") from exc
         except OSError as exc:
             raise RuntimeError(f"smartctl failed to start: {exc}") from exc
 
-    def _device(self, device: dict[str, str | None]) -> dict[str, Any]:
+        stdout: list[str] = []
+        stderr: list[str] = []
+        gathered = asyncio.gather(_drain(process.stdout, stdout), _drain(process.stderr, stderr), process.wait())
+        try:
+            await asyncio.wait_for(gathered, self.timeout)
+        except BaseException as exc:
+            # wait_for cancels the gather but never looks at its result;
+            # retrieve it so asyncio doesn't log it as unhandled
+            if gathered.done() and not gathered.cancelled():
+                gathered.exception()
+            # Timeout or cancellation: never leave a smartctl behind
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+            if isinstance(exc, asyncio.TimeoutError):
+                raise SmartctlTimeout(self.timeout, "".join(stdout), "".join(stderr)) from None
+            raise
+        assert process.returncode is not None
+        return subprocess.CompletedProcess(command, process.returncode, "".join(stdout), "".join(stderr))
+
+    async def _device(
+        self,
+        device: dict[str, str | None],
+        query: list[str] = FULL_ARGUMENTS,
+    ) -> dict[str, Any]:
         path = str(device["path"])
         item: dict[str, Any] = {
             "path": path,
@@ -126,11 +370,28 @@ class SmartCollector:
             "stderr": None,
         }
         try:
-            arguments = ["--json", "--all"]
+            arguments = ["--json", *query]
+            if self.skip_standby:
+                arguments.extend(STANDBY_ARGUMENTS)
             if device.get("scan_type"):
                 arguments.extend(["--device", str(device["scan_type"])])
             arguments.append(path)
-            result = self._run(arguments)
+            started = time.monotonic()
+            async with self.processes:
+                spawned = time.monotonic()
+                result = await self._run(arguments)
+            finished = time.monotonic()
+            item["query_seconds"] = round(finished - started, 3)
+            timing = self.device_timings[device_key(device)] = {
+                "queued_s": round(spawned - started, 4),
+                "smartctl_s": round(finished - spawned, 4),
+            }
+        except SmartctlTimeout as exc:
+            item["error"] = str(exc)
+            item["stderr"] = exc.stderr.strip() or None
+            if exc.stdout:
+                item["partial_output"] = exc.stdout[:PARTIAL_OUTPUT_LIMIT]
+            return item
         except RuntimeError as exc:
             item["error"] = str(exc)
             return item
@@ -139,55 +400,65 @@ class SmartCollector:
         item["stderr"] = result.stderr.strip() or None
         raw: dict[str, Any] | None = None
         if result.stdout.strip():
+            started = time.perf_counter()
             try:
                 parsed = json.loads(result.stdout)
                 if isinstance(parsed, dict):
                     raw = parsed
             except json.JSONDecodeError:
                 item["error"] = "smartctl returned invalid JSON"
+            timing["parse_s"] = round(time.perf_counter() - started, 6)
 
         item["query_status"] = _query_status(raw, result.returncode)
+        if item["query_status"] == "standby":
+            # Nothing was read from the sleeping disk; report what we last saw
+            self._from_cache(item)
+            return item
         if raw is not None:
+            started = time.perf_counter()
             item["summary"] = summarize(raw)
+            timing["summarize_s"] = round(time.perf_counter() - started, 6)
             item["smartctl"] = raw
+            self.cache[device_key(device)] = {
+                "summary": item["summary"],
+                "smartctl": raw,
+                "collected_at": utc_now(),
+            }
         elif "error" not in item:
             item["error"] = item["stderr"] or "smartctl returned no JSON"
         return item
 
-    def _snapshot(self) -> dict[str, Any]:
-        collected_at = utc_now()
-        try:
-            scan = self._run(["--scan-open"])
-        except RuntimeError as exc:
-            return {
-                "schema": SCHEMA,
-                "host": socket.gethostname(),
-                "collected_at": collected_at,
-                "status": "error",
-                "smartctl": self.smartctl,
-                "devices": [],
-                "summary": {"total": 0, "ok": 0, "warning": 0, "failed": 0, "unknown": 0, "errors": 1},
-                "errors": [str(exc)],
-            }
+    def _error_snapshot(self, collected_at: str, error: str) -> dict[str, Any]:
+        return {
+            "schema": SCHEMA,
+            "host": socket.gethostname(),
+            "collected_at": collected_at,
+            "status": "error",
+            "smartctl": self.smartctl,
+            "devices": [],
+            "summary": {"total": 0, "ok": 0, "warning": 0, "failed": 0, "unknown": 0, "standby": 0, "errors": 1},
+            "errors": [error],
+        }
 
+    async def _scan(self) -> tuple[subprocess.CompletedProcess[str], list[dict[str, str | None]]]:
+        started = time.monotonic()
+        scan = await self._run(["--scan-open"])
         devices = parse_scan(scan.stdout)
-        if not devices:
-            detail = scan.stderr.strip() or "smartctl scan found no devices"
-            return {
-                "schema": SCHEMA,
-                "host": socket.gethostname(),
-                "collected_at": collected_at,
-                "status": "error",
-                "smartctl": self.smartctl,
-                "devices": [],
-                "summary": {"total": 0, "ok": 0, "warning": 0, "failed": 0, "unknown": 0, "errors": 1},
-                "errors": [detail],
-            }
+        self.scan_seconds = round(time.monotonic() - started, 4)
+        return scan, devices
 
-        with ThreadPoolExecutor(max_workers=min(4, len(devices))) as pool:
-            collected = list(pool.map(self._device, devices))
+    def scan(self) -> tuple[subprocess.CompletedProcess[str], list[dict[str, str | None]]]:
+        """Run smartctl --scan-open; raises RuntimeError if smartctl cannot run."""
+        return asyncio.run(self._scan())
 
-        counts = {status: sum(item["query_status"] == status for item in collected) for status in ("ok", "warning", "failed", "unknown", "error")}
+    def assemble(
+        self,
+        collected_at: str,
+        scan: subprocess.CompletedProcess[str],
+        collected: list[dict[str, Any]],
+    ) -> dict[str, Any]:
+        """Build the snapshot payload from per-device results."""
+        counts = {status: sum(item["query_status"] == status for item in collected) for status in QUERY_STATUSES}
         if counts["error"] == len(collected):
             status = "error"
         elif scan.returncode or any(
@@ -203,17 +474,18 @@ class SmartCollector:
                 or f"smartctl scan exited with status {scan.returncode}"
             )
         errors.extend(
-            f"{item['path']}: {item['error']}"
+            f"{device_key(item)}: {item['error']}"
             for item in collected
             if item.get("error")
         )
-        return {
+        payload = {
             "schema": SCHEMA,
             "host": socket.gethostname(),
             "collected_at": collected_at,
             "status": status,
             "smartctl": self.smartctl,
             "scan_exit_status": scan.returncode,
+            "collector": {"groups": self.groups},
             "devices": collected,
             "summary": {
                 "total": len(collected),
@@ -221,29 +493,125 @@ class SmartCollector:
                 "warning": counts["warning"],
                 "failed": counts["failed"],
                 "unknown": counts["unknown"],
+                "standby": counts["standby"],
                 "errors": counts["error"],
             },
             "errors": errors,
         }
+        if self.timings:
+            payload["timings"] = self._timings(collected)
+        return payload
+
+    def _timings(self, collected: list[dict[str, Any]]) -> dict[str, Any]:
+        keys = [device_key(item) for item in collected]
+        devices = {key: self.device_timings[key] for key in keys if key in self.device_timings}
+        slowest = max(devices, key=lambda key: devices[key]["smartctl_s"], default=None)
+        # ru_maxrss is in KiB on Linux
+        return {
+            "scan_s": self.scan_seconds,
+            "collect_s": self.collect_seconds,
+            "slowest_device": slowest,
+            "devices": devices,
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "smartctl_peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    async def _collect_group(
+        self,
+        key: str,
+        devices: list[tuple[int, dict[str, str | None]]],
+        query: list[str],
+        results: list[dict[str, Any] | None],
+    ) -> None:
+        state = self.groups.get(key, {})
+        maximum = len(devices) if key == "nvme" else min(GROUP_MAX_LIMIT, len(devices))
+        initial = maximum if key == "nvme" else state.get("limit", GROUP_INITIAL_LIMIT)
+        limiter = AdaptiveLimit(initial, maximum, state.get("best_latency_s"))
+
+        async def run(index: int, device: dict[str, str | None]) -> None:
+            concurrency = await limiter.acquire()
+            started = time.monotonic()
+            try:
+                results[index] = await self._device(device, query)
+            finally:
+                await limiter.release(concurrency, time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*(run(index, device) for index, device in devices))
+        self.groups[key] = {
+            "devices": len(devices),
+            "limit": limiter.limit,
+            "best_latency_s": None if limiter.best is None else round(limiter.best, 3),
+            "elapsed_s": round(time.monotonic() - started, 3),
+        }
+
+    async def _collect(
+        self,
+        devices: list[dict[str, str | None]],
+        query: list[str] = FULL_ARGUMENTS,
+    ) -> list[dict[str, Any]]:
+        if not devices:
+            return []
+        # Bound to the running loop, so created per collection
+        self.processes = asyncio.Semaphore(MAX_PROCESSES)
+        groups: dict[str, list[tuple[int, dict[str, str | None]]]] = {}
+        for index, device in enumerate(devices):
+            groups.setdefault(controller_key(device), []).append((index, device))
+        results: list[dict[str, Any] | None] = [None] * len(devices)
+        started = time.monotonic()
+        await asyncio.gather(
+            *(self._collect_group(key, members, query, results) for key, members in groups.items())
+        )
+        self.collect_seconds = round(time.monotonic() - started, 4)
+        return [item for item in results if item is not None]
+
+    def collect(
+        self,
+        devices: list[dict[str, str | None]],
+        query: list[str] = FULL_ARGUMENTS,
+    ) -> list[dict[str, Any]]:
+        """Query devices, preserving their order.
+
+        Each controller group gets its own adaptively bounded queue and the
+        groups run side by side on one event loop, so a collection takes as
+        long as the slowest controller rather than the sum of them.
+        """
+        return asyncio.run(self._collect(devices, query))
+
+    async def _snapshot_async(self) -> dict[str, Any]:
+        collected_at = utc_now()
+        try:
+            scan, devices = await self._scan()
+        except RuntimeError as exc:
+            return self._error_snapshot(collected_at, str(exc))
+
+        if not devices:
+            detail = scan.stderr.strip() or "smartctl scan found no devices"
+            return self._error_snapshot(collected_at, detail)
+
+        return self.assemble(collected_at, scan, await self._collect(devices))
+
+    def _snapshot(self) -> dict[str, Any]:
+        return asyncio.run(self._snapshot_async())
 
     def snapshot(self) -> dict[str, Any]:
         return self._snapshot()
 
 
-def write_snapshot(path: str | Path, payload: dict[str, Any]) -> None:
-    """Write JSON atomically so readers never observe a partial snapshot."""
+def write_atomic(path: str | Path, data: str | bytes, mode: int = 0o640) -> None:
+    """Write data atomically so readers never observe a partial file."""
     target = Path(path)
     target.parent.mkdir(parents=True, exist_ok=True)
     descriptor, temporary_name = tempfile.mkstemp(
         prefix=f".{target.name}.",
         dir=target.parent,
-        text=True,
     )
+    if isinstance(data, str):
+        data = data.encode("utf-8")
     try:
-        with os.fdopen(descriptor, "w", encoding="utf-8") as handle:
-            os.fchmod(handle.fileno(), 0o640)
-            json.dump(payload, handle, indent=2, sort_keys=True)
-            handle.write("\n")
+        with os.fdopen(descriptor, "wb") as handle:
+            os.fchmod(handle.fileno(), mode)
+            handle.write(data)
             handle.flush()
             os.fsync(handle.fileno())
         os.replace(temporary_name, target)
@@ -255,6 +623,778 @@ def write_snapshot(path: str | Path, payload: dict[str, Any]) -> None:
         raise
 
 
+def write_snapshot(path: str | Path, payload: dict[str, Any]) -> None:
+    """Write JSON atomically so readers never observe a partial snapshot."""
+    if payload.get("schema") == SLIM_SCHEMA:
+        text = json.dumps(payload, separators=(",", ":"), sort_keys=True)
+    else:
+        text = json.dumps(payload, indent=2, sort_keys=True)
+    write_atomic(path, text + "\n")
+
+
+class RawStore:
+    """Per-device sidecar files holding raw smartctl JSON for the slim schema.
+
+    A sidecar is rewritten only when its content hash changes, and files for
+    devices that disappeared are removed.
+    """
+
+    def __init__(self, directory: Path, compress: bool = False) -> None:
+        self.directory = directory
+        self.compress = compress
+        self.suffix = ".json.gz" if compress else ".json"
+        self.refs: dict[str, dict[str, str]] = {}
+
+    def load_refs(self, payload: dict[str, Any]) -> None:
+        """Remember sidecars referenced by a previous slim snapshot."""
+        for item in payload.get("devices") or []:
+            ref = item.get("raw") if isinstance(item, dict) else None
+            if isinstance(ref, dict) and ref.get("path") and ref.get("sha256"):
+                self.refs[device_key(item)] = {"path": ref["path"], "sha256": ref["sha256"]}
+
+    def _path(self, key: str) -> Path:
+        name = re.sub(r"[^A-Za-z0-9]+", "_", key).strip("_")
+        return self.directory / f"{name}{self.suffix}"
+
+    def store(self, key: str, raw: dict[str, Any] | None) -> dict[str, str] | None:
+        if raw is None:
+            # Nothing new to say (error or cold standby); keep pointing at the last sidecar
+            return self.refs.get(key)
+        encoded = json.dumps(raw, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        digest = hashlib.sha256(encoded).hexdigest()
+        path = self._path(key)
+        previous = self.refs.get(key)
+        if previous is None or previous["sha256"] != digest or not path.exists():
+            if self.compress:
+                encoded = gzip.compress(encoded, mtime=0)
+            write_atomic(path, encoded)
+        self.refs[key] = {"path": str(path), "sha256": digest}
+        return self.refs[key]
+
+    def prune(self, keys: set[str]) -> None:
+        wanted = {self._path(key) for key in keys}
+        for key in set(self.refs) - keys:
+            del self.refs[key]
+        try:
+            candidates = list(self.directory.iterdir())
+        except FileNotFoundError:
+            return
+        for path in candidates:
+            if path.name.endswith(self.suffix) and not path.name.startswith(".") and path not in wanted:
+                path.unlink(missing_ok=True)
+
+
+def slim_snapshot(payload: dict[str, Any], store: RawStore) -> dict[str, Any]:
+    """Return the payload with raw smartctl JSON moved into sidecar files."""
+    devices = []
+    for item in payload.get("devices") or []:
+        key = device_key(item)
+        slim = {name: value for name, value in item.items() if name != "smartctl"}
+        slim["raw"] = store.store(key, item.get("smartctl"))
+        devices.append(slim)
+    store.prune({device_key(item) for item in devices})
+    return {**payload, "schema": SLIM_SCHEMA, "devices": devices}
+
+
+def _label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict[str, Any]) -> str:
+    pairs = ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items() if value is not None)
+    return "{" + pairs + "}" if pairs else ""
+
+
+# (metric, summary field, help); booleans are exported as 0/1
+DEVICE_GAUGES = [
+    ("smartmon_smart_passed", "smart_passed", "SMART overall health self-assessment passed (1) or failed (0)."),
+    ("smartmon_temperature_celsius", "temperature_c", "Current drive temperature."),
+    ("smartmon_percentage_used", "percentage_used", "NVMe endurance estimate used, in percent."),
+    ("smartmon_media_errors", "media_errors", "NVMe unrecovered media and data integrity errors."),
+    ("smartmon_error_log_entries", "error_log_entries", "Entries in the ATA error log or NVMe error information log."),
+    ("smartmon_available_spare", "available_spare", "NVMe remaining spare capacity, in percent."),
+    ("smartmon_reallocated_sectors", "reallocated_sectors", "ATA attribute 5, reallocated sector count."),
+    ("smartmon_pending_sectors", "pending_sectors", "ATA attribute 197, current pending sector count."),
+    ("smartmon_offline_uncorrectable", "offline_uncorrectable", "ATA attribute 198, offline uncorrectable sectors."),
+    ("smartmon_udma_crc_errors", "udma_crc_errors", "ATA attribute 199, UDMA CRC error count."),
+    ("smartmon_power_on_hours", "power_on_hours", "Power-on time in hours."),
+]
+
+
+def render_openmetrics(payload: dict[str, Any]) -> str:
+    """Render the snapshot summary as OpenMetrics text (node_exporter textfile compatible)."""
+    lines: list[str] = []
+
+    def family(name: str, help_text: str, samples: list[tuple[dict[str, Any], Any]]) -> None:
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            if isinstance(value, bool):
+                value = int(value)
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+    devices = [item for item in payload.get("devices") or [] if isinstance(item, dict)]
+    summary = payload.get("summary") or {}
+    family(
+        "smartmon_snapshot_ok",
+        "Whether every device was queried cleanly (1), or the snapshot is partial or failed (0).",
+        [({}, payload.get("status") == "ok")],
+    )
+    try:
+        collected = _parse_time(str(payload.get("collected_at"))).timestamp()
+    except ValueError:
+        collected = None
+    family("smartmon_collected_timestamp_seconds", "Time the snapshot was assembled.", [({}, collected)])
+    family(
+        "smartmon_devices",
+        "Devices by query status.",
+        [({"status": status}, summary.get(status)) for status in ("total", "ok", "warning", "failed", "unknown", "standby", "errors")],
+    )
+    family(
+        "smartmon_device_info",
+        "Device identity; always 1.",
+        [
+            (
+                {
+                    "device": device_key(item),
+                    "path": item["path"],
+                    "type": item.get("scan_type"),
+                    "model": (item.get("summary") or {}).get("model"),
+                    "serial": (item.get("summary") or {}).get("serial"),
+                    "firmware": (item.get("summary") or {}).get("firmware"),
+                },
+                1,
+            )
+            for item in devices
+        ],
+    )
+    family(
+        "smartmon_device_query_status",
+        "Outcome of the last smartctl query; the sample with value 1 is current.",
+        [
+            ({"device": device_key(item), "status": status}, int(item.get("query_status") == status))
+            for item in devices
+            for status in QUERY_STATUSES
+        ],
+    )
+    family(
+        "smartmon_cache_age_seconds",
+        "Age of the cached summary served for a device in standby.",
+        [({"device": device_key(item)}, item.get("cache_age_seconds")) for item in devices],
+    )
+    for name, field, help_text in DEVICE_GAUGES:
+        family(
+            name,
+            help_text,
+            [({"device": device_key(item)}, (item.get("summary") or {}).get(field)) for item in devices],
+        )
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serve the latest rendered metrics over HTTP from a background thread."""
+
+    content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, address: str) -> None:
+        host, _, port = address.rpartition(":")
+        self.body = b"# EOF\n"
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.body
+                self.send_response(200)
+                self.send_header("Content-Type", server.content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer((host.strip("[]"), int(port)), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+
+    def publish(self, text: str) -> None:
+        self.body = text.encode("utf-8")
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def read_snapshot(path: str | Path) -> dict[str, Any] | None:
+    """Load a previously written snapshot, or None if missing or unreadable."""
+    try:
+        with Path(path).open(encoding="utf-8") as handle:
+            payload = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+# Summary fields kept in the history; counters must only ever go up
+HISTORY_COUNTERS = (
+    "reallocated_sectors",
+    "pending_sectors",
+    "offline_uncorrectable",
+    "udma_crc_errors",
+    "media_errors",
+    "error_log_entries",
+)
+HISTORY_FIELDS = (
+    "temperature_c",
+    "percentage_used",
+    "available_spare",
+    "power_on_hours",
+    *HISTORY_COUNTERS,
+)
+# Samples older than the retention of their resolution are folded into the
+# next coarser one: raw samples for a week, hourly for a quarter, then daily.
+HISTORY_LEVELS = (
+    (0, 7 * 86400, 3600),
+    (3600, 90 * 86400, 86400),
+)
+# Don't store a new raw sample more often than this per device
+HISTORY_MIN_SPACING = 300
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value: str) -> int:
+    """Parse '90m', '36h', '14d' or plain seconds."""
+    value = value.strip()
+    unit = DURATION_UNITS.get(value[-1:].lower())
+    try:
+        return int(float(value[:-1]) * unit) if unit else int(float(value))
+    except ValueError as exc:
+        raise ValueError(f"invalid duration: {value!r}") from exc
+
+
+class HistoryStore:
+    """Append-only SQLite time series of summary fields, keyed by serial number."""
+
+    def __init__(self, path: str | Path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(f"{field} REAL" for field in HISTORY_FIELDS)
+        self.db.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS devices (
+                serial TEXT PRIMARY KEY,
+                device TEXT NOT NULL,
+                model TEXT,
+                last_seen INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                serial TEXT NOT NULL,
+                resolution INTEGER NOT NULL,
+                taken_at INTEGER NOT NULL,
+                {columns},
+                PRIMARY KEY (serial, resolution, taken_at)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def record(self, payload: dict[str, Any]) -> None:
+        """Add a raw sample for every freshly queried device, then downsample."""
+        now = int(time.time())
+        with self.db:
+            for item in payload.get("devices") or []:
+                summary = item.get("summary") or {}
+                if item.get("query_status") in ("standby", "error") or not summary.get("serial"):
+                    continue
+                serial = str(summary["serial"])
+                last = self.db.execute(
+                    "SELECT MAX(taken_at) FROM samples WHERE serial = ? AND resolution = 0",
+                    (serial,),
+                ).fetchone()[0]
+                self.db.execute(
+                    "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?)",
+                    (serial, device_key(item), summary.get("model"), now),
+                )
+                if last is not None and now - last < HISTORY_MIN_SPACING:
+                    continue
+                values = [
+                    float(summary[field]) if isinstance(summary.get(field), (int, float)) else None
+                    for field in HISTORY_FIELDS
+                ]
+                self.db.execute(
+                    f"INSERT OR REPLACE INTO samples VALUES (?, 0, ?, {', '.join('?' * len(HISTORY_FIELDS))})",
+                    (serial, now, *values),
+                )
+            self._downsample(now)
+
+    def _downsample(self, now: int) -> None:
+        for source, retention, target in HISTORY_LEVELS:
+            # Align to the target bucket so no bucket is ever half folded
+            cutoff = (now - retention) // target * target
+            aggregates = ", ".join(
+                f"AVG({field})" if field == "temperature_c"
+                else f"MIN({field})" if field == "available_spare"
+                else f"MAX({field})"
+                for field in HISTORY_FIELDS
+            )
+            self.db.execute(
+                f"""
+                INSERT OR REPLACE INTO samples
+                SELECT serial, ?, taken_at / ? * ?, {aggregates}
+                FROM samples WHERE resolution = ? AND taken_at < ?
+                GROUP BY serial, taken_at / ?
+                """,
+                (target, target, target, source, cutoff, target),
+            )
+            self.db.execute(
+                "DELETE FROM samples WHERE resolution = ? AND taken_at < ?",
+                (source, cutoff),
+            )
+
+    def trends(self, since: int, serial: str | None = None) -> list[dict[str, Any]]:
+        """Per-device change of each field between the first and last sample since a time."""
+        query = "SELECT serial, device, model FROM devices"
+        arguments: tuple[Any, ...] = ()
+        if serial:
+            query += " WHERE serial = ?"
+            arguments = (serial,)
+        report = []
+        for device_serial, device, model in self.db.execute(query + " ORDER BY device", arguments).fetchall():
+            rows = self.db.execute(
+                f"SELECT taken_at, {', '.join(HISTORY_FIELDS)} FROM samples "
+                "WHERE serial = ? AND taken_at >= ? ORDER BY taken_at",
+                (device_serial, since),
+            ).fetchall()
+            if not rows:
+                continue
+            span_days = max(rows[-1][0] - rows[0][0], 1) / 86400
+            fields: dict[str, Any] = {}
+            for index, field in enumerate(HISTORY_FIELDS, start=1):
+                values = [row[index] for row in rows if row[index] is not None]
+                if not values:
+                    continue
+                delta = values[-1] - values[0]
+                fields[field] = {
+                    "first": values[0],
+                    "last": values[-1],
+                    "min": min(values),
+                    "max": max(values),
+                    "delta": delta,
+                    "per_day": round(delta / span_days, 3),
+                }
+            increasing = [field for field in HISTORY_COUNTERS if fields.get(field, {}).get("delta", 0) > 0]
+            report.append(
+                {
+                    "serial": device_serial,
+                    "device": device,
+                    "model": model,
+                    "samples": len(rows),
+                    "first_sample": datetime.fromtimestamp(rows[0][0], timezone.utc).isoformat().replace("+00:00", "Z"),
+                    "last_sample": datetime.fromtimestamp(rows[-1][0], timezone.utc).isoformat().replace("+00:00", "Z"),
+                    "fields": fields,
+                    "increasing": increasing,
+                }
+            )
+        return report
+
+
+def history_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="smartmon-helper history",
+        description="Report trends from the history store; exits 1 if any error counter grew.",
+    )
+    parser.add_argument("--db", type=Path, default=os.environ.get("SMARTMON_HISTORY"), required=not os.environ.get("SMARTMON_HISTORY"))
+    parser.add_argument("--since", default="30d", help="how far back to look, e.g. 36h, 30d (default 30d)")
+    parser.add_argument("--serial", help="only this device")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    try:
+        since = int(time.time()) - parse_duration(args.since)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if not args.db.exists():
+        parser.error(f"no history at {args.db}")
+
+    store = HistoryStore(args.db)
+    try:
+        report = store.trends(since, args.serial)
+    finally:
+        store.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for device in report:
+            flag = "INCREASING " + ",".join(device["increasing"]) if device["increasing"] else "stable"
+            print(f"{device['device']}  {device['model'] or '?'}  {device['serial']}  {device['samples']} samples  {flag}")
+            for field, values in device["fields"].items():
+                print(
+                    f"    {field:22} {values['first']:>10g} -> {values['last']:<10g}"
+                    f" (min {values['min']:g}, max {values['max']:g}, {values['per_day']:+g}/day)"
+                )
+    return 1 if any(device["increasing"] for device in report) else 0
+
+
+# Summary fields that move on every poll and alone don't warrant a rewrite
+VOLATILE_SUMMARY_FIELDS = ("temperature_c", "power_on_hours")
+# ...except temperature, once it drifts this far from the last written value
+TEMPERATURE_CHANGE_C = 3
+
+
+def _stable_device(item: dict[str, Any]) -> dict[str, Any]:
+    summary = item.get("summary") or {}
+    return {
+        "query_status": item.get("query_status"),
+        "exit_status": item.get("exit_status"),
+        "error": item.get("error"),
+        "summary": {key: value for key, value in summary.items() if key not in VOLATILE_SUMMARY_FIELDS},
+    }
+
+
+def _temperature_moved(before: Any, after: Any) -> bool:
+    if isinstance(before, (int, float)) and isinstance(after, (int, float)):
+        return abs(after - before) >= TEMPERATURE_CHANGE_C
+    return (before is None) != (after is None)
+
+
+def diff_snapshots(old: dict[str, Any] | None, new: dict[str, Any]) -> dict[str, Any]:
+    """Describe meaningful changes between two snapshots, ignoring volatile fields.
+
+    The result has ``changed`` plus added/removed devices, query status
+    transitions and non-volatile summary field changes. Temperature counts
+    once it has moved TEMPERATURE_CHANGE_C degrees from ``old``.
+    """
+    old = old or {}
+    old_devices = {device_key(item): item for item in old.get("devices") or [] if isinstance(item, dict)}
+    new_devices = {device_key(item): item for item in new.get("devices") or []}
+    transitions = []
+    changes = []
+    for key in old_devices.keys() & new_devices.keys():
+        before, after = _stable_device(old_devices[key]), _stable_device(new_devices[key])
+        if before["query_status"] != after["query_status"]:
+            transitions.append({"device": key, "from": before["query_status"], "to": after["query_status"]})
+        for field in sorted(before["summary"].keys() | after["summary"].keys()):
+            if before["summary"].get(field) != after["summary"].get(field):
+                changes.append(
+                    {
+                        "device": key,
+                        "field": field,
+                        "from": before["summary"].get(field),
+                        "to": after["summary"].get(field),
+                    }
+                )
+        old_temperature = (old_devices[key].get("summary") or {}).get("temperature_c")
+        new_temperature = (new_devices[key].get("summary") or {}).get("temperature_c")
+        if _temperature_moved(old_temperature, new_temperature):
+            changes.append({"device": key, "field": "temperature_c", "from": old_temperature, "to": new_temperature})
+        for field in ("exit_status", "error"):
+            if before[field] != after[field]:
+                changes.append({"device": key, "field": field, "from": before[field], "to": after[field]})
+    diff: dict[str, Any] = {
+        "from": old.get("collected_at"),
+        "to": new.get("collected_at"),
+        "added": sorted(new_devices.keys() - old_devices.keys()),
+        "removed": sorted(old_devices.keys() - new_devices.keys()),
+        "transitions": sorted(transitions, key=lambda entry: entry["device"]),
+        "summary_changes": sorted(changes, key=lambda entry: (entry["device"], entry["field"])),
+        "status": None,
+    }
+    if old.get("status") != new.get("status"):
+        diff["status"] = {"from": old.get("status"), "to": new.get("status")}
+    diff["changed"] = bool(
+        diff["added"] or diff["removed"] or diff["transitions"] or diff["summary_changes"] or diff["status"]
+        or old.get("errors") != new.get("errors")
+        or old.get("scan_exit_status") != new.get("scan_exit_status")
+    )
+    return diff
+
+
+class Publisher:
+    """Hand snapshots to every configured output.
+
+    The snapshot file (and its raw sidecars) is only rewritten when
+    something meaningful changed or the copy on disk is older than
+    ``refresh`` seconds; otherwise its mtime is bumped as a heartbeat.
+    Each meaningful change is also written to ``diff`` for alerting.
+    """
+
+    def __init__(
+        self,
+        output: Path | None = None,
+        textfile: Path | None = None,
+        exporter: MetricsServer | None = None,
+        raw_store: RawStore | None = None,
+        history: HistoryStore | None = None,
+        diff: Path | None = None,
+        refresh: float = 3600.0,
+        previous: dict[str, Any] | None = None,
+    ) -> None:
+        self.output = output
+        self.textfile = textfile
+        self.exporter = exporter
+        self.raw_store = raw_store
+        self.history = history
+        self.diff = diff
+        self.refresh = refresh
+        # What the snapshot file on disk currently holds
+        self.previous = previous
+        self.write_seconds: float | None = None
+
+    def _stale(self, payload: dict[str, Any]) -> bool:
+        if self.previous is None or self.previous.get("schema") != (SLIM_SCHEMA if self.raw_store else SCHEMA):
+            return True
+        try:
+            age = _parse_time(str(payload["collected_at"])) - _parse_time(str(self.previous["collected_at"]))
+        except (KeyError, ValueError):
+            return True
+        return age.total_seconds() >= self.refresh
+
+    def _write_output(self, payload: dict[str, Any]) -> None:
+        assert self.output is not None
+        changes = diff_snapshots(self.previous, payload)
+        if changes["changed"] or self._stale(payload) or not self.output.exists():
+            written = slim_snapshot(payload, self.raw_store) if self.raw_store else payload
+            write_snapshot(self.output, written)
+            if changes["changed"] and self.diff and self.previous is not None:
+                write_atomic(self.diff, json.dumps(changes, indent=2, sort_keys=True) + "\n")
+            self.previous = written
+        else:
+            # Heartbeat: readers can tell the collector is alive without a rewrite
+            os.utime(self.output)
+
+    def publish(self, payload: dict[str, Any]) -> None:
+        started = time.perf_counter()
+        if "timings" in payload:
+            # A write can't time itself; report how long the previous one took
+            payload["timings"]["last_write_s"] = self.write_seconds
+        self._publish(payload)
+        self.write_seconds = round(time.perf_counter() - started, 4)
+
+    def _publish(self, payload: dict[str, Any]) -> None:
+        if self.history:
+            try:
+                self.history.record(payload)
+            except sqlite3.Error as exc:
+                print(f"smartmon-helper: cannot record history: {exc}", file=sys.stderr)
+        if self.output:
+            self._write_output(payload)
+        if self.textfile or self.exporter:
+            metrics = render_openmetrics(payload)
+            if self.textfile:
+                # node_exporter runs as its own user and must be able to read it
+                write_atomic(self.textfile, metrics, mode=0o644)
+            if self.exporter:
+                self.exporter.publish(metrics)
+
+    def close(self) -> None:
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.history is not None:
+            self.history.close()
+
+
+class SmartDaemon:
+    """Keep the device list in memory and poll each device on its own schedule.
+
+    Every device gets a full ``--all`` query each ``interval`` seconds. NVMe
+    devices additionally get a light health/attribute poll each
+    ``nvme_interval`` seconds, merged over their last full result. The device
+    list is rescanned on udev block add/remove events and every
+    ``rescan_interval`` seconds. The result is handed to the publisher after
+    every poll. SIGTERM/SIGINT set an event the loop waits on; a poll in
+    flight is cancelled, which kills its smartctl processes.
+    """
+
+    def __init__(
+        self,
+        collector: SmartCollector,
+        publisher: Publisher,
+        interval: float = 3600.0,
+        nvme_interval: float = 60.0,
+        rescan_interval: float = 21600.0,
+        udevadm: str = "udevadm",
+    ) -> None:
+        self.collector = collector
+        self.publisher = publisher
+        self.interval = interval
+        self.nvme_interval = nvme_interval
+        self.rescan_interval = rescan_interval
+        self.udevadm = udevadm
+        self.scan: subprocess.CompletedProcess[str] | None = None
+        self.devices: dict[str, dict[str, str | None]] = {}
+        self.items: dict[str, dict[str, Any]] = {}
+        self.due: dict[str, dict[str, float]] = {}
+        self.next_rescan = 0.0
+
+    async def _rescan(self) -> None:
+        now = time.monotonic()
+        self.next_rescan = now + self.rescan_interval
+        try:
+            self.scan, devices = await self.collector._scan()
+        except RuntimeError as exc:
+            print(f"smartmon-helper: rescan failed: {exc}", file=sys.stderr)
+            return
+
+        current = {device_key(device): device for device in devices}
+        for key in set(self.devices) - set(current):
+            self.items.pop(key, None)
+            self.due.pop(key, None)
+        for key in current:
+            self.due.setdefault(key, {"full": now})
+        self.devices = current
+
+    def _next_due(self) -> float:
+        return min((when for due in self.due.values() for when in due.values()), default=self.next_rescan)
+
+    async def _poll_due(self) -> bool:
+        now = time.monotonic()
+        batches: dict[str, list[str]] = {"full": [], "quick": []}
+        for key, due in self.due.items():
+            # A full query also covers a quick poll that is due
+            if due["full"] <= now:
+                batches["full"].append(key)
+            elif due.get("quick", due["full"]) <= now:
+                batches["quick"].append(key)
+        if not batches["full"] and not batches["quick"]:
+            return False
+
+        for kind, query in (("full", FULL_ARGUMENTS), ("quick", QUICK_ARGUMENTS)):
+            keys = batches[kind]
+            devices = [self.devices[key] for key in keys]
+            for key, item in zip(keys, await self.collector._collect(devices, query)):
+                previous = self.items.get(key)
+                if (
+                    kind == "quick"
+                    and item["query_status"] != "standby"
+                    and previous
+                    and previous.get("smartctl")
+                    and item.get("smartctl")
+                ):
+                    raw = {**previous["smartctl"], **item["smartctl"]}
+                    item["smartctl"] = raw
+                    item["summary"] = summarize(raw)
+                self.items[key] = item
+
+        now = time.monotonic()
+        for key in batches["full"]:
+            self.due[key]["full"] = now + self.interval
+        for key in batches["full"] + batches["quick"]:
+            if _is_nvme(self.devices[key]) and 0 < self.nvme_interval < self.interval:
+                self.due[key]["quick"] = now + self.nvme_interval
+        return True
+
+    def _write(self) -> None:
+        if self.scan is None:
+            payload = self.collector._error_snapshot(utc_now(), "smartctl scan has not succeeded yet")
+        elif not self.devices:
+            detail = self.scan.stderr.strip() or "smartctl scan found no devices"
+            payload = self.collector._error_snapshot(utc_now(), detail)
+        else:
+            collected = [self.items[key] for key in self.devices if key in self.items]
+            payload = self.collector.assemble(utc_now(), self.scan, collected)
+        try:
+            self.publisher.publish(payload)
+        except OSError as exc:
+            print(f"smartmon-helper: cannot write snapshot: {exc}", file=sys.stderr)
+
+    async def _watch_udev(self, wake: asyncio.Event) -> None:
+        """Request a debounced rescan on udev block add/remove events."""
+        try:
+            monitor = await asyncio.create_subprocess_exec(
+                self.udevadm, "monitor", "--udev", "--subsystem-match=block",
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError as exc:
+            print(f"smartmon-helper: udev monitor unavailable ({exc}), rescanning on interval only", file=sys.stderr)
+            return
+        assert monitor.stdout is not None
+        try:
+            while line := await monitor.stdout.readline():
+                text = line.decode(errors="replace")
+                if " add " in text or " remove " in text:
+                    self.next_rescan = min(self.next_rescan, time.monotonic() + RESCAN_DEBOUNCE)
+                    wake.set()
+            # udevadm went away; fall back to the interval rescan
+        finally:
+            if monitor.returncode is None:
+                monitor.terminate()
+                await monitor.wait()
+
+    @staticmethod
+    async def _until(stop: asyncio.Event, work: Any) -> bool:
+        """Await ``work`` unless ``stop`` fires first, cancelling it; False if stopped."""
+        task = asyncio.ensure_future(work)
+        stopped = asyncio.ensure_future(stop.wait())
+        try:
+            await asyncio.wait({task, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return False
+        task.result()
+        return True
+
+    async def _run(self) -> int:
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        wake = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        watcher = asyncio.ensure_future(self._watch_udev(wake))
+        try:
+            if not await self._until(stop, self._rescan()):
+                return 0
+            self._write()
+            while not stop.is_set():
+                if time.monotonic() >= self.next_rescan:
+                    if not await self._until(stop, self._rescan()):
+                        break
+                    self._write()
+                polled = asyncio.ensure_future(self._poll_due())
+                if not await self._until(stop, polled):
+                    break
+                if polled.result():
+                    self._write()
+
+                timeout = max(0.0, min(self.next_rescan, self._next_due()) - time.monotonic())
+                wake.clear()
+                waiters = {asyncio.ensure_future(stop.wait()), asyncio.ensure_future(wake.wait())}
+                _, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
+            return 0
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+            watcher.cancel()
+            try:
+                await watcher
+            except asyncio.CancelledError:
+                pass
+            # Stops the metrics server and closes the history database
+            self.publisher.close()
+
+    def run(self) -> int:
+        return asyncio.run(self._run())
+
+
 def _env_float(name: str, default: float) -> float:
     try:
         return float(os.environ.get(name, str(default)))
@@ -263,27 +1403,183 @@ def _env_float(name: str, default: float) -> float:
 
 
 def main(argv: list[str] | None = None) -> int:
-    parser = argparse.ArgumentParser(description=__doc__)
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["history"]:
+        return history_main(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog="Run 'smartmon-helper history --help' for the trend report.",
+    )
     parser.add_argument(
         "--output",
         type=Path,
         default=os.environ.get("SMARTMON_OUTPUT"),
         help="write snapshot atomically to this path instead of stdout",
     )
+    parser.add_argument(
+        "--textfile",
+        type=Path,
+        default=os.environ.get("SMARTMON_TEXTFILE"),
+        help="also write OpenMetrics text here, e.g. for the node_exporter textfile collector",
+    )
+    parser.add_argument(
+        "--raw-dir",
+        type=Path,
+        default=os.environ.get("SMARTMON_RAW_DIR"),
+        help=f"write the slim {SLIM_SCHEMA} snapshot and keep raw smartctl JSON in per-device files here",
+    )
+    parser.add_argument(
+        "--raw-compress",
+        action="store_true",
+        default=os.environ.get("SMARTMON_RAW_COMPRESS") == "1",
+        help="gzip the raw sidecar files",
+    )
+    parser.add_argument(
+        "--refresh",
+        type=float,
+        default=_env_float("SMARTMON_REFRESH", 3600.0),
+        help="rewrite an unchanged snapshot after this many seconds; until then only its mtime is bumped",
+    )
+    parser.add_argument(
+        "--diff",
+        type=Path,
+        default=os.environ.get("SMARTMON_DIFF"),
+        help="write a JSON diff (devices added/removed, status transitions) here on every meaningful change",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        default=os.environ.get("SMARTMON_HISTORY"),
+        help="append key attributes to this SQLite history (downsampled; see 'history' subcommand)",
+    )
+    parser.add_argument(
+        "--listen",
+        default=os.environ.get("SMARTMON_LISTEN"),
+        help="daemon: serve OpenMetrics on HOST:PORT/metrics",
+    )
     parser.add_argument("--timeout", type=float, default=_env_float("SMARTMON_TIMEOUT", 45.0))
     parser.add_argument("--smartctl", default=os.environ.get("SMARTMON_SMARTCTL", "smartctl"))
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and poll devices on their own schedules (requires --output)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=_env_float("SMARTMON_INTERVAL", 3600.0),
+        help="daemon: seconds between full --all queries of each device",
+    )
+    parser.add_argument(
+        "--nvme-interval",
+        type=float,
+        default=_env_float("SMARTMON_NVME_INTERVAL", 60.0),
+        help="daemon: seconds between light health/temperature polls of NVMe devices (0 disables)",
+    )
+    parser.add_argument(
+        "--rescan-interval",
+        type=float,
+        default=_env_float("SMARTMON_RESCAN_INTERVAL", 21600.0),
+        help="daemon: seconds between device rescans when no udev event arrives",
+    )
+    parser.add_argument("--udevadm", default=os.environ.get("SMARTMON_UDEVADM", "udevadm"))
+    parser.add_argument(
+        "--skip-standby",
+        action="store_true",
+        default=os.environ.get("SMARTMON_SKIP_STANDBY") == "1",
+        help="do not wake sleeping disks; report them as standby with their last known summary",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=os.environ.get("SMARTMON_TIMINGS") == "1",
+        help="add a timings section (scan, per-device smartctl/parse/summarize, write, peak RSS)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="run under cProfile, dump stats to this file and print the top entries to stderr",
+    )
     args = parser.parse_args(argv)
+    if not args.profile:
+        return _run(parser, args)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return _run(parser, args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+
+
+def _run(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    collector = SmartCollector(
+        smartctl=args.smartctl,
+        timeout=args.timeout,
+        skip_standby=args.skip_standby,
+        timings=args.timings,
+    )
+    raw_store = RawStore(args.raw_dir, compress=args.raw_compress) if args.raw_dir else None
+    if args.raw_dir and not args.output:
+        parser.error("--raw-dir requires --output")
+    previous = read_snapshot(args.output) if args.output else None
+    if previous is not None:
+        collector.load_state(previous)
+        if raw_store is not None and previous.get("schema") == SLIM_SCHEMA:
+            raw_store.load_refs(previous)
+    if args.listen and not args.daemon:
+        parser.error("--listen requires --daemon")
+    try:
+        history = HistoryStore(args.history) if args.history else None
+    except (OSError, sqlite3.Error) as exc:
+        parser.error(f"cannot open history {args.history}: {exc}")
+    if args.diff and not args.output:
+        parser.error("--diff requires --output")
+    exporter = None
+    if args.daemon:
+        if not (args.output or args.textfile or args.listen or history):
+            parser.error("--daemon requires --output, --textfile, --listen or --history")
+        try:
+            exporter = MetricsServer(args.listen) if args.listen else None
+        except (OSError, ValueError) as exc:
+            parser.error(f"cannot listen on {args.listen}: {exc}")
+    publisher = Publisher(
+        output=args.output,
+        textfile=args.textfile,
+        exporter=exporter,
+        raw_store=raw_store,
+        history=history,
+        diff=args.diff,
+        refresh=args.refresh,
+        previous=previous,
+    )
+    if args.daemon:
+        daemon = SmartDaemon(
+            collector,
+            publisher,
+            interval=args.interval,
+            nvme_interval=args.nvme_interval,
+            rescan_interval=args.rescan_interval,
+            udevadm=args.udevadm,
+        )
+        return daemon.run()
 
-    collector = SmartCollector(smartctl=args.smartctl, timeout=args.timeout)
     payload = collector.snapshot()
     try:
-        if args.output:
-            write_snapshot(args.output, payload)
-        else:
+        publisher.publish(payload)
+        if args.timings:
+            # The snapshot can't carry its own write time; a daemon reports it on the next one
+            print(f"smartmon-helper: outputs written in {publisher.write_seconds:g}s", file=sys.stderr)
+        if not (args.output or args.textfile):
             print(json.dumps(payload, indent=2, sort_keys=True))
     except OSError as exc:
         print(f"smartmon-helper: cannot write snapshot: {exc}", file=sys.stderr)
         return 1
+    finally:
+        publisher.close()
     return 0 if payload["status"] == "ok" else 1
 
 
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Benchmark smartmon_helper.py against synthetic disks replayed by fake_smartctl.py.
+
+Generates fixture directories with 1 to 500 devices (NVMe plus disks behind
+megaraid controllers), then collects a snapshot in a fresh child process for
+every (device count, process cap) pair and records wall time, CPU time, peak
+RSS of the collector and its smartctl children, and snapshot size. Hot pure
+helpers (parse_scan, summarize, render_openmetrics) are timed in-process.
+Results are printed (or written) as JSON so runs can be compared.
+
+    python3 smartmon_helper_bench.py --devices 1,10,100,500 --latency 0.05 --output bench.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+
+import fake_smartctl  # noqa: E402
+import smartmon_helper  # noqa: E402
+
+
+FAKE_SMARTCTL = HERE / "fake_smartctl.py"
+DISKS_PER_CONTROLLER = 24
+
+
+def ata_fixture(serial: str, rng: random.Random) -> dict[str, Any]:
+    """Roughly the shape and size of `smartctl --json --all` for a SATA HDD."""
+    attributes = [
+        {
+            "id": attribute_id,
+            "name": f"Attribute_{attribute_id}",
+            "value": 100,
+            "worst": 100,
+            "thresh": 10,
+            "flags": {"value": 50, "string": "-O--CK ", "prefailure": False},
+            "raw": {"value": rng.randrange(0, 8) if attribute_id in (5, 197, 198, 199) else rng.randrange(0, 50000), "string": "0"},
+        }
+        for attribute_id in (1, 3, 4, 5, 7, 9, 10, 12, 187, 188, 190, 192, 193, 194, 197, 198, 199, 240, 241, 242)
+    ]
+    return {
+        "json_format_version": [1, 0],
+        "smartctl": {"version": [7, 4], "exit_status": 0},
+        "device": {"name": "/dev/bus/0", "type": "megaraid", "protocol": "ATA"},
+        "model_family": "Synthetic HDD",
+        "model_name": "SYNTH HDD 18TB",
+        "serial_number": serial,
+        "wwn": {"naa": 5, "oui": 3152, "id": rng.getrandbits(36)},
+        "firmware_version": "SN03",
+        "user_capacity": {"blocks": 35156656128, "bytes": 18000207937536},
+        "smart_status": {"passed": True},
+        "temperature": {"current": rng.randrange(28, 45)},
+        "power_on_time": {"hours": rng.randrange(100, 40000)},
+        "ata_smart_attributes": {"revision": 10, "table": attributes},
+        "ata_smart_error_log": {"summary": {"revision": 1, "count": 0}},
+        "ata_smart_self_test_log": {
+            "standard": {
+                "revision": 1,
+                "table": [
+                    {"type": {"value": 1, "string": "Short offline"}, "status": {"value": 0, "passed": True}, "lifetime_hours": hours}
+                    for hours in range(0, 21 * 24, 24)
+                ],
+            }
+        },
+    }
+
+
+def nvme_fixture(serial: str, rng: random.Random) -> dict[str, Any]:
+    return {
+        "json_format_version": [1, 0],
+        "smartctl": {"version": [7, 4], "exit_status": 0},
+        "device": {"name": "/dev/nvme0", "type": "nvme", "protocol": "NVMe"},
+        "model_name": "SYNTH NVME 2TB",
+        "serial_number": serial,
+        "firmware_version": "1B2QEXM7",
+        "smart_status": {"passed": True},
+        "temperature": {"current": rng.randrange(30, 60)},
+        "power_on_time": {"hours": rng.randrange(100, 20000)},
+        "nvme_smart_health_information_log": {
+            "critical_warning": 0,
+            "temperature": rng.randrange(30, 60),
+            "available_spare": 100,
+            "available_spare_threshold": 10,
+            "percentage_used": rng.randrange(0, 30),
+            "data_units_read": rng.getrandbits(32),
+            "data_units_written": rng.getrandbits(32),
+            "power_on_hours": rng.randrange(100, 20000),
+            "unsafe_shutdowns": rng.randrange(0, 50),
+            "media_errors": 0,
+            "num_err_log_entries": rng.randrange(0, 5),
+        },
+    }
+
+
+def generate_fixtures(root: Path, count: int, nvme_fraction: float, faults: dict[str, Any], rng: random.Random) -> None:
+    devices_dir = root / "devices"
+    devices_dir.mkdir(parents=True)
+    scan_lines = []
+    nvme_count = round(count * nvme_fraction)
+    for index in range(count):
+        if index < nvme_count:
+            path, device_type = f"/dev/nvme{index}", "nvme"
+            raw = nvme_fixture(f"NVME{index:05d}", rng)
+            scan_lines.append(f"{path} -d nvme # {path}, NVMe device")
+        else:
+            disk = index - nvme_count
+            path = f"/dev/bus/{disk // DISKS_PER_CONTROLLER}"
+            device_type = f"megaraid,{disk % DISKS_PER_CONTROLLER}"
+            raw = ata_fixture(f"HDD{index:05d}", rng)
+            scan_lines.append(f"{path} -d {device_type} # {path} [megaraid_disk_{disk:02d}], SCSI device")
+        name = fake_smartctl.fixture_name(path, device_type)
+        (devices_dir / f"{name}.json").write_text(json.dumps(raw, indent=2))
+    (root / "scan-open.txt").write_text("\n".join(scan_lines) + "\n")
+    (root / "faults.json").write_text(json.dumps(faults))
+
+
+def child(fixtures: str, max_processes: int, timeout: float) -> int:
+    """Collect one snapshot and report cost; runs in a fresh interpreter."""
+    os.environ[fake_smartctl.FIXTURES_ENV] = fixtures
+    smartmon_helper.MAX_PROCESSES = max_processes
+    collector = smartmon_helper.SmartCollector(smartctl=str(FAKE_SMARTCTL), timeout=timeout, timings=True)
+    started = time.monotonic()
+    cpu = time.process_time()
+    payload = collector.snapshot()
+    elapsed = time.monotonic() - started
+    encoded = json.dumps(payload, indent=2, sort_keys=True)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    json.dump(
+        {
+            "wall_s": round(elapsed, 3),
+            "cpu_s": round(time.process_time() - cpu, 3),
+            "children_cpu_s": round(children.ru_utime + children.ru_stime, 3),
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "smartctl_peak_rss_kib": children.ru_maxrss,
+            "snapshot_bytes": len(encoded),
+            "status": payload["status"],
+            "summary": payload["summary"],
+            "scan_s": payload["timings"]["scan_s"],
+            "groups": payload["collector"]["groups"],
+        },
+        sys.stdout,
+    )
+    return 0
+
+
+def bench_case(fixtures: Path, max_processes: int, timeout: float) -> dict[str, Any]:
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", str(fixtures), str(max_processes), str(timeout)],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode:
+        return {"error": result.stderr.strip()[-2000:]}
+    report = json.loads(result.stdout)
+    # Group detail is noisy at 500 devices; keep the limits the collector settled on
+    report["group_limits"] = sorted({state["limit"] for state in report.pop("groups").values()})
+    return report
+
+
+def bench_helpers(rng: random.Random, iterations: int) -> dict[str, Any]:
+    scan = "\n".join(
+        f"/dev/bus/{index // DISKS_PER_CONTROLLER} -d megaraid,{index % DISKS_PER_CONTROLLER} # disk {index}"
+        for index in range(500)
+    )
+    ata = ata_fixture("HDD", rng)
+    nvme = nvme_fixture("NVME", rng)
+    results: dict[str, Any] = {}
+
+    started = time.perf_counter()
+    for _ in range(max(1, iterations // 100)):
+        smartmon_helper.parse_scan(scan)
+    results["parse_scan_500_us"] = round((time.perf_counter() - started) / max(1, iterations // 100) * 1e6, 2)
+
+    for label, raw in (("ata", ata), ("nvme", nvme)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            smartmon_helper.summarize(raw)
+        results[f"summarize_{label}_us"] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+
+    payload = {
+        "status": "ok",
+        "collected_at": smartmon_helper.utc_now(),
+        "summary": {"total": 500},
+        "devices": [
+            {"path": f"/dev/bus/0", "scan_type": f"megaraid,{index}", "query_status": "ok", "summary": smartmon_helper.summarize(ata)}
+            for index in range(500)
+        ],
+    }
+    started = time.perf_counter()
+    text = smartmon_helper.render_openmetrics(payload)
+    results["render_openmetrics_500_ms"] = round((time.perf_counter() - started) * 1e3, 2)
+    results["openmetrics_500_bytes"] = len(text)
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--child"]:
+        return child(argv[1], int(argv[2]), float(argv[3]))
+
+    parser = argparse.ArgumentParser(description="Benchmark smartmon_helper.py against replayed synthetic disks.")
+    parser.add_argument("--devices", default="1,10,50,100,250,500", help="comma-separated device counts")
+    parser.add_argument("--max-processes", default="4,16,64", help="comma-separated caps on concurrent smartctl processes")
+    parser.add_argument("--nvme-fraction", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per smartctl query")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--serialise-controllers", action=argparse.BooleanOptionalAction, default=True,
+                        help="megaraid disks on one controller answer one at a time")
+    parser.add_argument("--fail", choices=["timeout", "invalid-json", "exit", "standby"], help="inject this failure")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=5.0, help="per-device smartctl deadline")
+    parser.add_argument("--iterations", type=int, default=10000, help="helper micro-benchmark iterations")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", type=Path, help="where to build fixtures (default: a temp dir)")
+    parser.add_argument("--output", type=Path, help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    faults: dict[str, Any] = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "serialise_controllers": args.serialise_controllers,
+    }
+    if args.fail:
+        faults.update({"fail": args.fail, "fail_rate": args.fail_rate})
+
+    with tempfile.TemporaryDirectory(prefix="smartmon-bench-", dir=args.workdir) as work:
+        cases = []
+        for count in (int(value) for value in args.devices.split(",")):
+            fixtures = Path(work) / f"devices-{count}"
+            generate_fixtures(fixtures, count, args.nvme_fraction, faults, rng)
+            for max_processes in (int(value) for value in args.max_processes.split(",")):
+                report = bench_case(fixtures, max_processes, args.timeout)
+                cases.append({"devices": count, "max_processes": max_processes, **report})
+                print(
+                    f"{count:>4} devices, max {max_processes:>3} processes: "
+                    f"{report.get('wall_s', 'error')}s, peak RSS {report.get('peak_rss_kib', '?')} KiB",
+                    file=sys.stderr,
+                )
+
+    results = {
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "cases": cases,
+        "helpers": bench_helpers(rng, args.iterations),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())